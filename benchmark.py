@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+
+# Benchmarks of tokenization, context assembly, ingestion, embedding and vector search.
+# Results are written as JSON, so that the results of two commits can be compared:
+#
+#   python3 benchmark.py --database-url postgresql://bench:pw@localhost/bench --output new.json
+#   python3 benchmark.py --compare old.json new.json
+#
+# LLM requests go to llm-standin.py, started automatically without delays unless --llm-url
+# is given. The benchmarks using the database reset it: never give the database of the bot.
+# Without --database-url only the tokenizer and context benchmarks are run.
+
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+import yaml
+
+import context
+import database
+import librarian
+import llm
+
+BENCHMARKS = ( 'tokenizer', 'context', 'ingest', 'embedding', 'search' )
+DATABASE_BENCHMARKS = ( 'ingest', 'embedding', 'search' )
+VOCABULARY_SIZE = 5000
+FILE_SIZE = 100000              # bytes per ingested file
+TOKENIZER_SIZE = 1 << 20        # bytes of text tokenized
+TOKEN_POS_LOOKUPS = 200         # in a text of FILE_SIZE bytes
+CONTEXT_LENGTHS = ( 10, 100, 1000, 10000 )  # Dialogue chunks
+CONTEXT_MIN_TIME = 0.5          # seconds of repeated measurements per length
+EMBEDDING_ROWS = 500
+SEARCH_SIZES = '10000,100000,1000000'
+SEARCH_QUERIES = 200
+LOAD_BATCH = 10000              # Chunks inserted at a time when loading the search benchmark
+REGRESSION_THRESHOLD = 0.1      # Relative change reported as regression
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--config', help='Configuration file for model names and other settings')
+parser.add_argument('--database-url', help='PostgreSQL database (with pgvector) which can be reset')
+parser.add_argument('--llm-url', help='OpenAI-compatible server instead of llm-standin.py')
+parser.add_argument('--output', default='benchmark.json', help='File for the results')
+parser.add_argument('--only', action='append', choices=BENCHMARKS, help='Run only this benchmark (can be repeated)')
+parser.add_argument('--ingest-mb', type=float, default=1.0, help='Megabytes of text ingested')
+parser.add_argument('--search-sizes', default=SEARCH_SIZES, help='Numbers of chunks for vector search, comma separated')
+parser.add_argument('--queries', type=int, default=SEARCH_QUERIES, help='Vector searches per size')
+parser.add_argument('--seed', type=int, default=1)
+parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='Compare two result files instead of running')
+parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD, help='Relative change reported as regression')
+args = parser.parse_args()
+
+
+def higher_is_better(name):
+    return name.endswith('_per_second')
+
+def compare(old, new, threshold):
+    # Print the change of each metric, return the number of regressions
+    print(f'Comparing {old.get("commit")} ({old.get("time")}) -> {new.get("commit")} ({new.get("time")})')
+    regressions = 0
+    for name in sorted(set(old['results']) | set(new['results'])):
+        a = old['results'].get(name)
+        b = new['results'].get(name)
+        if a is None or b is None:
+            print(f'{name:45} {a!s:>12} {b!s:>12}')
+            continue
+        change = (b - a) / a if a else 0.0
+        worse = -change if higher_is_better(name) else change
+        flag = ''
+        if worse > threshold:
+            flag = 'REGRESSION'
+            regressions += 1
+        elif worse < -threshold:
+            flag = 'improved'
+        print(f'{name:45} {a:12.4g} {b:12.4g} {change:+8.1%} {flag}')
+    return regressions
+
+
+class Text():
+    # Deterministic text resembling documents: words with Zipf-like frequencies,
+    # sentences, paragraphs and section headings
+    def __init__(self, rng):
+        self._rng = rng
+        syllables = [ c + v for c in 'bcdfghjklmnprstv' for v in 'aeiou' ]
+        self._vocabulary = [ ''.join(rng.choices(syllables, k=rng.randint(1, 4))) for _ in range(VOCABULARY_SIZE) ]
+        self._weights = [ 1 / (i + 1) for i in range(VOCABULARY_SIZE) ]
+
+    def sentence(self):
+        words = self._rng.choices(self._vocabulary, self._weights, k=self._rng.randint(6, 20))
+        return ' '.join(words).capitalize() + '.'
+
+    def make(self, size):
+        parts = []
+        length = 0
+        section = 0
+        while length < size:
+            if section == 0 or self._rng.random() < 0.2:
+                section += 1
+                parts.append(f'## Section {section}: {self.sentence()[:-1]}\n\n')
+            parts.append(' '.join(self.sentence() for _ in range(self._rng.randint(3, 8))) + '\n\n')
+            length += len(parts[-1])
+        return ''.join(parts)[:size]
+
+
+def measure(f, min_time=CONTEXT_MIN_TIME, min_repeats=5):
+    # Median time of calls of f in seconds
+    times = []
+    start = time.perf_counter()
+    while len(times) < min_repeats or time.perf_counter() - start < min_time:
+        t = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - t)
+    return statistics.median(times)
+
+def random_embedding(rng):
+    return [ rng.random() - 0.5 for _ in range(database.EMBEDDING_DIMENSIONS) ]
+
+def quiet():
+    # The benchmarked code prints progress, which is not part of the results
+    return contextlib.redirect_stdout(open(os.devnull, 'w'))
+
+
+def bench_tokenizer(results, text):
+    tokenizer = librarian.Tokenizer()
+    data = text.make(TOKENIZER_SIZE)
+    start = time.perf_counter()
+    tokens = tokenizer.tokenize(data)
+    results['tokenizer.tokens_per_second'] = tokens.count() / (time.perf_counter() - start)
+    data = data[:FILE_SIZE]
+    tokens = tokenizer.tokenize(data)
+    rng = random.Random(args.seed)
+    positions = [ rng.randrange(len(data) - 1) for _ in range(TOKEN_POS_LOOKUPS) ]
+    start = time.perf_counter()
+    for p in positions:
+        tokens.token_pos(p)
+    results['tokenizer.token_pos_per_second'] = TOKEN_POS_LOOKUPS / (time.perf_counter() - start)
+
+def bench_context(results, text):
+    for n in CONTEXT_LENGTHS:
+        with quiet():
+            dialogue = context.SectionDialogue()
+            for i in range(n):
+                if i % 3 == 0:
+                    dialogue.add_chunk(service='message', extra='user="@bench:example.org"', content=text.sentence())
+                elif i % 3 == 1:
+                    dialogue.add_chunk(content=f'{text.sentence()}\n```python\nsend_message("{text.sentence()}")\n```')
+                else:
+                    dialogue.add_chunk(service='python', content='Message sent')
+        manager = context.ContextManager([ context.SectionInstructions(), context.SectionGoals(), dialogue ])
+        results[f'context.messages_ms.{n}'] = measure(manager.messages) * 1000
+
+def standin_paths(config):
+    # Numbers of requests by path from llm-standin.py, None for other servers
+    try:
+        response = requests.get(config['openai_url'] + '/stats', timeout=5)
+        return response.json()['paths']
+    except (requests.exceptions.RequestException, ValueError, KeyError):
+        return None
+
+def bench_ingest(results, text, lib, config):
+    files = [ text.make(FILE_SIZE) for _ in range(max(1, int(args.ingest_mb * 1e6 / FILE_SIZE))) ]
+    size = sum(len(f.encode('utf-8')) for f in files)
+    tokens = sum(lib.tokenizer.tokenize(f).count() for f in files)
+    before = standin_paths(config)
+    start = time.perf_counter()
+    with quiet():
+        for i, data in enumerate(files):
+            lib.add_file(f'benchmark-{i}.txt', data=data)
+    elapsed = time.perf_counter() - start
+    after = standin_paths(config)
+    results['ingest.tokens_per_second'] = tokens / elapsed
+    results['ingest.bytes_per_second'] = size / elapsed
+    if before is not None and after is not None:
+        for path, name in ( ('/v1/chat/completions', 'llm_calls_per_mb'), ('/v1/embeddings', 'embeddings_per_mb') ):
+            results[f'ingest.{name}'] = (after.get(path, 0) - before.get(path, 0)) / (size / 1e6)
+
+def make_chunk(i, content, embedding=None):
+    return {
+        'content':              content,
+        'filename':             f'benchmark-{i // 1000}',
+        'chunk_begin':          i,
+        'chunk_end':            i + len(content),
+        'depth':                1,
+        'original_filename':    'benchmark',
+        'original_begin':       0,
+        'original_end':         0,
+        'keywords':             [],
+        'embedding':            embedding,
+    }
+
+def bench_embedding(results, text, db):
+    rng = random.Random(args.seed)
+    chunks = [ make_chunk(i, ' '.join(text.sentence() for _ in range(10))) for i in range(EMBEDDING_ROWS) ]
+    start = time.perf_counter()
+    for c in chunks:
+        db.add_chunk(c)
+    results['embedding.rows_per_second'] = EMBEDDING_ROWS / (time.perf_counter() - start)
+    chunks = [ make_chunk(i, c['content'], random_embedding(rng)) for i, c in enumerate(chunks) ]
+    start = time.perf_counter()
+    db.add_chunks(chunks)
+    results['embedding.bulk_rows_per_second'] = EMBEDDING_ROWS / (time.perf_counter() - start)
+
+def bench_search(results, db):
+    rng = random.Random(args.seed)
+    with quiet():
+        db.reset()
+    loaded = 0
+    for size in sorted(int(s) for s in args.search_sizes.split(',')):
+        start = time.perf_counter()
+        while loaded < size:
+            n = min(LOAD_BATCH, size - loaded)
+            db.add_chunks([ make_chunk(loaded + i, f'chunk {loaded + i}', random_embedding(rng)) for i in range(n) ])
+            loaded += n
+            print(f'Search: loaded {loaded} chunks', end='\r', flush=True)
+        print(f'Search: loaded {loaded} chunks in {time.perf_counter() - start:.1f}s')
+        for _ in range(10):             # Warm up caches
+            db.search(random_embedding(rng))
+        times = []
+        for _ in range(args.queries):
+            q = random_embedding(rng)
+            t = time.perf_counter()
+            db.search(q)
+            times.append(time.perf_counter() - t)
+        times.sort()
+        results[f'search.p50_ms.{size}'] = llm.percentile(times, 0.5) * 1000
+        results[f'search.p99_ms.{size}'] = llm.percentile(times, 0.99) * 1000
+
+def start_standin():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'llm-standin.py')
+    process = subprocess.Popen([ sys.executable, script, '--port', str(port), '--latency', '0',
+        '--prompt-latency', '0', '--token-latency', '0', '--embedding-latency', '0',
+        '--embedding-dimensions', str(database.EMBEDDING_DIMENSIONS) ], stdout=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}'
+    for _ in range(100):
+        try:
+            requests.get(url + '/health', timeout=1)
+            return process, url
+        except requests.exceptions.ConnectionError:
+            time.sleep(0.1)
+    process.kill()
+    raise Exception('llm-standin.py did not start')
+
+def git_commit():
+    try:
+        return subprocess.run([ 'git', 'rev-parse', '--short', 'HEAD' ], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if args.compare:
+    old, new = ( json.load(open(pathname)) for pathname in args.compare )
+    sys.exit(1 if compare(old, new, args.threshold) else 0)
+
+selected = args.only or BENCHMARKS
+if not args.database_url:
+    skipped = [ b for b in selected if b in DATABASE_BENCHMARKS ]
+    if skipped:
+        print(f'No --database-url, skipping {", ".join(skipped)}')
+    selected = [ b for b in selected if b not in DATABASE_BENCHMARKS ]
+
+config = {}
+if args.config:
+    with open(args.config, 'r') as f:
+        config = yaml.safe_load(f)
+for k in ( 'endpoints', 'llm_cache', 'llm_record', 'database_url' ):
+    config.pop(k, None)         # Never touch the data of the bot
+config.setdefault('model_llm', 'benchmark')
+config.setdefault('model_embedding', 'benchmark')
+config.setdefault('openai_key', 'benchmark')
+config['database_url'] = args.database_url
+
+standin = None
+if args.llm_url:
+    config['openai_url'] = args.llm_url
+else:
+    standin, config['openai_url'] = start_standin()
+
+text = Text(random.Random(args.seed))
+results = {}
+try:
+    for name in selected:
+        print(f'Benchmark: {name}')
+        if name == 'tokenizer':
+            bench_tokenizer(results, text)
+        elif name == 'context':
+            bench_context(results, text)
+        else:
+            with quiet():
+                lib = librarian.Librarian(config, path=tempfile.mkdtemp(prefix='benchmark-'))
+                lib.db.reset()
+            if name == 'ingest':
+                bench_ingest(results, text, lib, config)
+            elif name == 'embedding':
+                bench_embedding(results, text, lib.db)
+            else:
+                bench_search(results, lib.db)
+finally:
+    if standin is not None:
+        standin.kill()
+
+for name, value in sorted(results.items()):
+    print(f'{name:45} {value:12.4g}')
+output = {
+    'commit':       git_commit(),
+    'time':         datetime.datetime.now().isoformat(timespec='seconds'),
+    'llm_url':      args.llm_url,
+    'parameters':   { 'ingest_mb': args.ingest_mb, 'search_sizes': args.search_sizes, 'queries': args.queries, 'seed': args.seed },
+    'results':      results,
+}
+with open(args.output, 'w') as f:
+    json.dump(output, f, indent=2)
+print(f'Results written to {args.output}')
@@ -0,0 +1,104 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+CACHE_MAX_SIZE = 1 << 30    # bytes
+EVICT_BATCH = 100           # Entries removed at a time when the cache is full
+
+CREATE_SQL = '''
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_used ON responses (used);
+'''
+
+
+def key(path: str, payload: dict):
+    # Canonical hash of the request: the same request gives the same key regardless of
+    # the order of the fields. The model is part of the payload.
+    canonical = json.dumps({ 'path': path, 'payload': payload }, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class ResponseCache():
+    # Persistent cache of deterministic LLM responses (JSON) in an SQLite file. When the
+    # total size exceeds max_size, the least recently used responses are removed.
+    def __init__(self, pathname, max_size=CACHE_MAX_SIZE):
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(pathname, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(CREATE_SQL)
+        self._size = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        self.stats = { 'hits': 0, 'misses': 0, 'evictions': 0 }
+
+    def get(self, key):
+        # Return the cached response or None
+        with self._lock:
+            row = self._db.execute('SELECT value FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.stats['misses'] += 1
+                return None
+            self._db.execute('UPDATE responses SET used = ? WHERE key = ?', (time.time(), key))
+            self.stats['hits'] += 1
+        return json.loads(row[0])
+
+    def put(self, key, response):
+        value = json.dumps(response, ensure_ascii=False)
+        size = len(value.encode('utf-8'))
+        if size > self._max_size:
+            return
+        with self._lock:
+            old = self._db.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self._db.execute('INSERT OR REPLACE INTO responses (key, value, size, used) VALUES (?, ?, ?, ?)',
+                (key, value, size, time.time()))
+            self._size += size - (old[0] if old else 0)
+            while self._size > self._max_size:
+                rows = self._db.execute('SELECT key, size FROM responses ORDER BY used LIMIT ?', (EVICT_BATCH,)).fetchall()
+                evict = []
+                for k, s in rows:
+                    if self._size <= self._max_size:
+                        break
+                    evict.append((k,))
+                    self._size -= s
+                self._db.executemany('DELETE FROM responses WHERE key = ?', evict)
+                self.stats['evictions'] += len(evict)
+
+    def hit_rate(self):
+        requests = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / requests if requests else 0.0
+
+    def size(self):
+        return self._size
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def open_cache(pathname, max_size=CACHE_MAX_SIZE):
+    # Return the shared cache for the file, so that all Llm objects use the same statistics
+    with _caches_lock:
+        if pathname not in _caches:
+            _caches[pathname] = ResponseCache(pathname, max_size)
+        return _caches[pathname]
+
+
+# Tests
+if __name__ == '__main__':
+    import os
+    import tempfile
+    pathname = os.path.join(tempfile.mkdtemp(), 'cache.sqlite')
+    c = ResponseCache(pathname, max_size=1000)
+    k1 = key('/v1/embeddings', { 'model': 'm', 'input': 'a' })
+    print(f'Same key regardless of order: {k1 == key("/v1/embeddings", { "input": "a", "model": "m" })}')
+    print(f'Miss: {c.get(k1)}')
+    c.put(k1, { 'data': [ 1.0, 2.0 ] })
+    print(f'Hit: {c.get(k1)}')
+    for i in range(50):
+        c.put(key('/v1/embeddings', { 'input': str(i) }), { 'data': 'x' * 50 })
+    print(f'Size {c.size()} after evictions {c.stats["evictions"]}, hit rate {c.hit_rate():.2f}')
@@ -0,0 +1,79 @@
+import gzip
+import json
+import threading
+
+import cache
+
+TRANSPORT_FIELDS = ( 'id_slot', )   # Payload fields which do not affect the response
+
+
+def request_key(path: str, payload: dict):
+    # Key of a request for finding its recorded response
+    return cache.key(path, { k: v for k, v in payload.items() if k not in TRANSPORT_FIELDS })
+
+def _open(pathname, mode):
+    if pathname.endswith('.gz'):
+        return gzip.open(pathname, mode + 't', encoding='utf-8')
+    return open(pathname, mode, encoding='utf-8')
+
+
+class Cassette():
+    # Record of LLM requests and responses, one JSON object per line (gzip compressed
+    # if the file name ends with .gz). A record contains the request path, key and
+    # payload, the HTTP status, the time to the response headers ('latency'), and either
+    # the JSON 'response' or the streamed 'chunks' as [ seconds from start, data ].
+    def __init__(self, pathname):
+        self._pathname = pathname
+        self._lock = threading.Lock()
+
+    def record(self, path, payload, status, latency, response=None, chunks=None):
+        entry = {
+            'path':     path,
+            'key':      request_key(path, payload),
+            'payload':  payload,
+            'status':   status,
+            'latency':  round(latency, 4),
+        }
+        if chunks is not None:
+            entry['chunks'] = [ [ round(t, 4), d ] for t, d in chunks ]
+        else:
+            entry['response'] = response
+        line = json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n'
+        with self._lock:
+            with _open(self._pathname, 'a') as f:
+                f.write(line)
+
+    def load(self):
+        # Return the records as a dictionary key -> list of records in recording order
+        records = {}
+        with _open(self._pathname, 'r') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    records.setdefault(entry['key'], []).append(entry)
+        return records
+
+
+_cassettes = {}
+_cassettes_lock = threading.Lock()
+
+def open_cassette(pathname):
+    # Return the shared cassette for the file, so that records of all Llm objects are
+    # written through the same lock
+    with _cassettes_lock:
+        if pathname not in _cassettes:
+            _cassettes[pathname] = Cassette(pathname)
+        return _cassettes[pathname]
+
+
+# Tests
+if __name__ == '__main__':
+    import os
+    import tempfile
+    pathname = os.path.join(tempfile.mkdtemp(), 'cassette.jsonl.gz')
+    c = Cassette(pathname)
+    c.record('/v1/embeddings', { 'input': 'a' }, 200, 0.1, response={ 'data': [] })
+    c.record('/v1/chat/completions', { 'stream': True, 'id_slot': 1 }, 200, 0.2, chunks=[ (0.3, '{}'), (0.4, '[DONE]') ])
+    records = c.load()
+    print(f'Records: {sum(len(r) for r in records.values())}, '
+          f'streamed found without id_slot: {request_key("/v1/chat/completions", { "stream": True }) in records}')
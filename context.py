@@ -1,6 +1,15 @@
 import datetime
+import time
 
+import metrics
 import system_prompt
+import tools
+
+TOOLS_SECTION = 'full'      # 'full': documentation of all functions, 'index': one line per function
+
+ASSEMBLY_SECONDS = metrics.histogram('scrittabot_context_assembly_seconds', 'Duration of assembling the messages of the context')
+MESSAGES = metrics.gauge('scrittabot_context_messages', 'Messages in the latest assembled context')
+CHUNKS = metrics.counter('scrittabot_dialogue_chunks_total', 'Chunks added to the dialogue by service', ( 'service', ))
 
 def get_time():
     """
@@ -34,17 +43,26 @@ class SectionInstructions(Section):
         return [( 'text', 'system', '', '', system_prompt.SYSTEM_PROMPT + '\n' )]
 
 class SectionTools(Section):
-    def __init__(self, tool_list):
+    def __init__(self, tool_list, mode=TOOLS_SECTION):
         super().__init__()
         self._tool_list = tool_list
-
-    def content(self):
-        prompt = '## Functions\n\nThese special functions are available for you to help to advance your goals.\n\n```python\n'
+        if mode not in ( 'full', 'index' ):
+            raise Exception(f'Unsupported tools section mode {mode}')
+        self._mode = mode
+
+    def text(self, mode):
+        prompt = '## Functions\n\nThese special functions are available for you to help to advance your goals.\n\n'
+        if mode == 'index':
+            prompt += 'Call help(name) to see the full documentation of a function before using it the first time.\n\n'
+        prompt += '```python\n'
         for tool in self._tool_list:
             for t in tool.tools():
-                prompt += 'def ' + t[0] + '\n'
+                prompt += tools.tool_summary(t[0]) + '\n' if mode == 'index' else 'def ' + t[0] + '\n'
         prompt += '```\n\n'
-        return [( 'text', 'system', '', '', prompt )]
+        return prompt
+
+    def content(self):
+        return [( 'text', 'system', '', '', self.text(self._mode) )]
 
 class SectionMood(Section):
     def __init__(self):
@@ -124,6 +142,7 @@ class SectionDialogue(Section):
         print(f'ADD_CHUNK(media_type="{media_type}", service="{service}", extra="{extra}", content="{content if content is None or len(content)<256 else '...'}")')
         if media_type == 'text' and content == '':
             raise Exception('Empty text content')
+        CHUNKS.inc(service=service or 'assistant')
         if extra:
             extra = ' ' + extra.strip()
         extra += f' time="{get_time()}"'
@@ -160,6 +179,7 @@ class ContextManager():
         self._sections = sections
 
     def messages(self):
+        start = time.monotonic()
         messages = [{ 'role': 'system', 'content': '' }]
         last_role = messages[0]['role']
         for section in self._sections:
@@ -196,6 +216,8 @@ class ContextManager():
         # Last message must always be from user, otherwise LLM returns empty string. FIXME: better handling
         if messages[-1]['role'] != 'user':
             messages.append({ 'role': 'user', 'content': f'<system time="{get_time()}"></system>\n' })
+        ASSEMBLY_SECONDS.observe(time.monotonic() - start)
+        MESSAGES.set(len(messages))
         return messages
 
     def reduce(self):
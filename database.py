@@ -1,14 +1,21 @@
 #!/usr/bin/env python3
 
+import contextlib
 import hashlib
 import psycopg2
 import psycopg2.extras      # dictionary cursors
+import threading
 import urllib.parse
 from pgvector.psycopg2 import register_vector
 
 import llm
+import metrics
 
 EMBEDDING_DIMENSIONS = 1024
+SEARCH_LIMIT = 10           # Default number of chunks returned by search()
+BULK_PAGE_SIZE = 1000       # Rows inserted per statement by add_chunks()
+
+OPERATION_SECONDS = metrics.histogram('scrittabot_db_seconds', 'Duration of database writes and searches by operation', ( 'operation', ))
 
 # Create initially the database manually as follows:
 #  su postgres -c psql
@@ -21,6 +28,11 @@ EMBEDDING_DIMENSIONS = 1024
 DROP_TABLES_SQL = """
 DROP TABLE IF EXISTS edges CASCADE;
 DROP TABLE IF EXISTS chunks CASCADE;
+DROP TABLE IF EXISTS files CASCADE;
+DROP TABLE IF EXISTS images CASCADE;
+DROP TABLE IF EXISTS terms CASCADE;
+DROP TABLE IF EXISTS corpus CASCADE;
+DROP TABLE IF EXISTS neardup CASCADE;
 """
 
 CREATE_CHUNKS_TABLE_SQL = f"""
@@ -62,6 +74,84 @@ CREATE TABLE edges (
 );
 """
 
+CREATE_FILES_TABLE_SQL = """
+CREATE TABLE files (
+    name TEXT PRIMARY KEY,          -- Name of the file in the files directory
+    filename TEXT NOT NULL,
+    ext TEXT,                       -- Extension of internal index files, NULL for other files
+    parent TEXT,                    -- File which an internal index file belongs to
+    unsecure_filename TEXT NOT NULL,
+    type VARCHAR(50) NOT NULL,      -- e.g., 'generic', 'text', 'image'
+    sha256 VARCHAR(64) NOT NULL,
+    size BIGINT NOT NULL CHECK (size >= 0),
+    indexed BOOLEAN DEFAULT FALSE NOT NULL,
+    source TEXT,                    -- Where the file was received from, e.g. Matrix mxc URI
+    created TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP NOT NULL
+);
+CREATE INDEX ON files (sha256);
+CREATE INDEX ON files (source);
+CREATE INDEX ON files (parent);
+"""
+
+CREATE_IMAGES_TABLE_SQL = """
+CREATE TABLE images (
+    imagehash BIGINT NOT NULL,      -- Perceptual hash of the image
+    bands INTEGER[] NOT NULL,       -- Parts of the hash for near-duplicate lookup
+    keywords TEXT[],
+    description_long TEXT NOT NULL,
+    description_short TEXT NOT NULL,
+    created TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP NOT NULL
+);
+CREATE INDEX ON images USING gin (bands);
+"""
+
+CREATE_TERMS_TABLE_SQL = """
+CREATE TABLE terms (
+    term TEXT PRIMARY KEY,
+    df BIGINT NOT NULL CHECK (df >= 0)      -- Number of chunks containing the term
+);
+"""
+
+CREATE_CORPUS_TABLE_SQL = """
+CREATE TABLE corpus (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),     -- Only a single row
+    documents BIGINT NOT NULL CHECK (documents >= 0),   -- Number of chunks
+    words BIGINT NOT NULL CHECK (words >= 0)            -- Total number of words in the chunks
+);
+INSERT INTO corpus (documents, words) VALUES (0, 0);
+"""
+
+CREATE_NEARDUP_TABLE_SQL = """
+CREATE TABLE neardup (
+    chunk BIGINT PRIMARY KEY,
+    signature BIGINT[] NOT NULL,    -- MinHash signature of the original text of the chunk
+    bands BIGINT[] NOT NULL,        -- Hashed signature bands for near-duplicate lookup
+    summary TEXT NOT NULL,          -- Content of the chunk, for reuse
+
+    FOREIGN KEY (chunk) REFERENCES chunks(key) ON DELETE CASCADE
+);
+CREATE INDEX ON neardup USING gin (bands);
+"""
+
+# Tables in creation order
+TABLES = {
+    'chunks':   CREATE_CHUNKS_TABLE_SQL,
+    'edges':    CREATE_EDGES_TABLE_SQL,
+    'files':    CREATE_FILES_TABLE_SQL,
+    'images':   CREATE_IMAGES_TABLE_SQL,
+    'terms':    CREATE_TERMS_TABLE_SQL,
+    'corpus':   CREATE_CORPUS_TABLE_SQL,
+    'neardup':  CREATE_NEARDUP_TABLE_SQL,
+}
+
+# Bring tables created by earlier versions up to date
+MIGRATE_SQL = """
+ALTER TABLE files ADD COLUMN IF NOT EXISTS source TEXT;
+CREATE INDEX IF NOT EXISTS files_source_idx ON files (source);
+"""
+
+FILE_FIELDS = ( 'name', 'filename', 'ext', 'parent', 'unsecure_filename', 'type', 'sha256', 'size', 'indexed', 'source' )
+
 class Database():
     def __init__(self, config):
         url = urllib.parse.urlparse(config['database_url'])
@@ -80,26 +170,46 @@ class Database():
                 del params[k]
         print(f'Connecting to database "{params["database"]}"')
         self._db = psycopg2.connect(**params)
+        self._lock = threading.RLock()
         with self._db.cursor() as cur:
              cur.execute("SET TIMEZONE TO 'UTC';")
              self._db.commit()
         register_vector(self._db)
-        if not self._check():
+        missing = self._check()
+        if len(missing) == len(TABLES):
             print('Creating new database')
             self.reset()
+        elif missing:
+            print(f'Creating missing tables {missing}')
+            self._create(missing)
+        self._migrate()
         options = { 'model': config['model_embedding'] }
-        self._llm = llm.Llm(config['openai_url'], config['openai_key'], options, insecure=True)
+        self._llm = llm.Llm(config['openai_url'], config['openai_key'], options, insecure=True,
+            **llm.config_options(config))
+
+    @contextlib.contextmanager
+    def _cursor(self, **kwargs):
+        # The connection is shared by the main, ingestion, and Matrix threads, so only one
+        # transaction runs at a time. It is committed at the end, or rolled back on errors.
+        with self._lock:
+            try:
+                with self._db.cursor(**kwargs) as cur:
+                    yield cur
+                self._db.commit()
+            except Exception:
+                self._db.rollback()
+                raise
 
     def __del__(self):
         self._db.close()
 
     def _check(self):
-        # Check that the relations exist, create if not
-        # We count how many of the specified table names exist as 'r' (regular table) in the given schema.
+        # Check that the relations exist, return list of the missing ones
+        # We list which of the specified table names exist as 'r' (regular table) in the given schema.
         schema_name = 'public'
-        table_names = ( 'chunks', 'edges' )
+        table_names = tuple(TABLES.keys())
         sql_query = """
-            SELECT COUNT(*)
+            SELECT c.relname
             FROM pg_class c
             JOIN pg_namespace n ON n.oid = c.relnamespace
             WHERE c.relkind = 'r'
@@ -111,18 +221,39 @@ class Database():
                 # Execute the query, passing schema_name and table_names as parameters
                 # psycopg2 automatically handles the list/tuple for the IN clause
                 cur.execute(sql_query, (schema_name, table_names))
-                count = cur.fetchone()[0]
-                return count == len(table_names)
+                found = [ r[0] for r in cur.fetchall() ]
+                return [ t for t in table_names if t not in found ]
         except psycopg2.Error as e:
             print(f'Error checking for table existence: {e}')
-            return False
+            return list(table_names)
+
+    def _create(self, tables):
+        try:
+            with self._db.cursor() as cur:
+                for t in tables:
+                    cur.execute(TABLES[t])
+            self._db.commit()
+        except psycopg2.Error as e:
+            self._db.rollback()
+            print(f'Error creating tables ({e}), rolled back')
+            raise e
+
+    def _migrate(self):
+        try:
+            with self._db.cursor() as cur:
+                cur.execute(MIGRATE_SQL)
+            self._db.commit()
+        except psycopg2.Error as e:
+            self._db.rollback()
+            print(f'Error migrating tables ({e}), rolled back')
+            raise e
 
     def reset(self):
         try:
             with self._db.cursor() as cur:
                 cur.execute(DROP_TABLES_SQL)
-                cur.execute(CREATE_CHUNKS_TABLE_SQL)
-                cur.execute(CREATE_EDGES_TABLE_SQL)
+                for sql in TABLES.values():
+                    cur.execute(sql)
             self._db.commit()
             print(f'Database resetted successfully')
         except psycopg2.Error as e:
@@ -132,7 +263,7 @@ class Database():
 
     def add_chunk(self, chunk):
         # chunk: must contain fields below AND 'content'
-        # Adds 'embedding', 'sha256', and 'key', also returns key
+        # Adds 'embedding' (unless given), 'sha256', and 'key', also returns key
         insert_sql = """
             INSERT INTO chunks (
                 filename,
@@ -151,9 +282,10 @@ class Database():
                 %s, %s, %s
             ) RETURNING key;
         """
-        chunk['embedding'] = self._llm.embedding(chunk['content'])
+        if chunk.get('embedding') is None:
+            chunk['embedding'] = self._llm.embedding(chunk['content'])
         chunk['sha256'] = hashlib.sha256(chunk['content'].encode('utf-8')).hexdigest()
-        with self._db.cursor() as cur:
+        with OPERATION_SECONDS.time(operation='add_chunk'), self._cursor() as cur:
             data = (
                 chunk.get('filename'),
                 chunk.get('chunk_begin'),
@@ -168,10 +300,176 @@ class Database():
             )
             cur.execute(insert_sql, data)
             key = cur.fetchone()[0]
-            self._db.commit()
         chunk['key'] = key
         return key
 
+    def add_chunks(self, chunks):
+        # Bulk insert of chunks in one transaction, otherwise as add_chunk(). Returns the keys.
+        insert_sql = """
+            INSERT INTO chunks (
+                filename, chunk_begin, chunk_end, depth,
+                original_filename, original_begin, original_end,
+                sha256, embedding, keywords
+            ) VALUES %s RETURNING key;
+        """
+        data = []
+        for chunk in chunks:
+            if chunk.get('embedding') is None:
+                chunk['embedding'] = self._llm.embedding(chunk['content'])
+            chunk['sha256'] = hashlib.sha256(chunk['content'].encode('utf-8')).hexdigest()
+            data.append(tuple(chunk.get(f) for f in ( 'filename', 'chunk_begin', 'chunk_end', 'depth',
+                'original_filename', 'original_begin', 'original_end', 'sha256', 'embedding', 'keywords' )))
+        with OPERATION_SECONDS.time(operation='add_chunks'), self._cursor() as cur:
+            keys = [ r[0] for r in psycopg2.extras.execute_values(cur, insert_sql, data,
+                template='(%s, %s, %s, %s, %s, %s, %s, %s, %s::vector, %s)', page_size=BULK_PAGE_SIZE, fetch=True) ]
+        for chunk, key in zip(chunks, keys):
+            chunk['key'] = key
+        return keys
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        # Return the chunks (without content) nearest to the query by cosine distance, nearest first.
+        # query: text, or its embedding
+        select_sql = """
+            SELECT key, filename, chunk_begin, chunk_end, depth,
+                   original_filename, original_begin, original_end, keywords,
+                   embedding <=> %(q)s::vector AS distance
+            FROM chunks
+            ORDER BY embedding <=> %(q)s::vector
+            LIMIT %(limit)s;
+        """
+        if isinstance(query, str):
+            query = self._llm.embedding(query)
+        with OPERATION_SECONDS.time(operation='search'), self._cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute(select_sql, { 'q': list(query), 'limit': limit })
+            chunks = [ dict(r) for r in cur.fetchall() ]
+        return chunks
+
+    def get_chunks(self, filename):
+        # Return the chunks (without content) of all internal index files belonging to filename
+        select_sql = """
+            SELECT key, filename, chunk_begin, chunk_end, depth,
+                   original_filename, original_begin, original_end, sha256, keywords
+            FROM chunks
+            WHERE filename IN (SELECT filename FROM files WHERE parent = %s)
+            ORDER BY depth, chunk_begin;
+        """
+        with self._cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute(select_sql, (filename,))
+            chunks = [ dict(r) for r in cur.fetchall() ]
+        return chunks
+
+    def delete_chunks(self, filename):
+        # Delete the chunks of all internal index files belonging to filename
+        delete_sql = """
+            DELETE FROM chunks
+            WHERE filename IN (SELECT filename FROM files WHERE parent = %s);
+        """
+        with OPERATION_SECONDS.time(operation='delete_chunks'), self._cursor() as cur:
+            cur.execute(delete_sql, (filename,))
+
+    def add_file(self, entry):
+        # entry: dictionary with the fields in FILE_FIELDS. Replaces existing entry with the same name.
+        insert_sql = f"""
+            INSERT INTO files ({', '.join(FILE_FIELDS)})
+            VALUES ({', '.join(['%s'] * len(FILE_FIELDS))})
+            ON CONFLICT (name) DO UPDATE SET
+                {', '.join(f'{f} = EXCLUDED.{f}' for f in FILE_FIELDS[1:])};
+        """
+        with OPERATION_SECONDS.time(operation='add_file'), self._cursor() as cur:
+            cur.execute(insert_sql, tuple(entry.get(f) for f in FILE_FIELDS))
+
+    def set_file_indexed(self, name, indexed=True):
+        with OPERATION_SECONDS.time(operation='set_file_indexed'), self._cursor() as cur:
+            cur.execute('UPDATE files SET indexed = %s WHERE name = %s;', (indexed, name))
+
+    def get_file(self, name):
+        # Return catalog entry of the file or None if it does not exist
+        return self._select_file('name = %s', (name,))
+
+    def find_file(self, sha256):
+        # Return catalog entry of an indexed, non-internal file with the given contents or None
+        return self._select_file('sha256 = %s AND ext IS NULL AND indexed', (sha256,))
+
+    def add_image_analysis(self, imagehash, bands, analysis):
+        # imagehash: unsigned 64-bit perceptual hash, stored as signed BIGINT
+        insert_sql = """
+            INSERT INTO images (imagehash, bands, keywords, description_long, description_short)
+            VALUES (%s, %s, %s, %s, %s);
+        """
+        with OPERATION_SECONDS.time(operation='add_image_analysis'), self._cursor() as cur:
+            data = (
+                imagehash - (1 << 64) if imagehash >= (1 << 63) else imagehash,
+                bands,
+                analysis['keywords'],
+                analysis['description_long'],
+                analysis['description_short'],
+            )
+            cur.execute(insert_sql, data)
+
+    def find_image_analyses(self, bands):
+        # Return analyses of all images sharing at least one hash band
+        select_sql = """
+            SELECT imagehash, keywords, description_long, description_short
+            FROM images WHERE bands && %s::INTEGER[];
+        """
+        with self._cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute(select_sql, (bands,))
+            analyses = [ dict(r) for r in cur.fetchall() ]
+        for a in analyses:
+            a['imagehash'] &= (1 << 64) - 1
+        return analyses
+
+    def add_near_duplicate(self, chunk_key, signature, bands, summary):
+        insert_sql = """
+            INSERT INTO neardup (chunk, signature, bands, summary) VALUES (%s, %s, %s, %s);
+        """
+        with OPERATION_SECONDS.time(operation='add_near_duplicate'), self._cursor() as cur:
+            cur.execute(insert_sql, (chunk_key, signature, bands, summary))
+
+    def find_near_duplicates(self, bands):
+        # Return candidate chunks sharing at least one signature band with their
+        # signature, summary, embedding, and keywords
+        select_sql = """
+            SELECT n.chunk, n.signature, n.summary, c.embedding, c.keywords
+            FROM neardup n JOIN chunks c ON c.key = n.chunk
+            WHERE n.bands && %s::BIGINT[];
+        """
+        with self._cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute(select_sql, (bands,))
+            candidates = [ dict(r) for r in cur.fetchall() ]
+        return candidates
+
+    def add_terms(self, terms, words):
+        # Update corpus statistics with a new document containing the given distinct terms
+        # and total number of words
+        insert_sql = """
+            INSERT INTO terms (term, df) VALUES %s
+            ON CONFLICT (term) DO UPDATE SET df = terms.df + 1;
+        """
+        with OPERATION_SECONDS.time(operation='add_terms'), self._cursor() as cur:
+            psycopg2.extras.execute_values(cur, insert_sql, [ (t, 1) for t in sorted(terms) ], page_size=1000)
+            cur.execute('UPDATE corpus SET documents = documents + 1, words = words + %s;', (words,))
+
+    def get_terms(self, terms):
+        # Return (number of documents, total number of words, { term: document frequency })
+        with self._cursor() as cur:
+            cur.execute('SELECT documents, words FROM corpus;')
+            documents, words = cur.fetchone()
+            cur.execute('SELECT term, df FROM terms WHERE term = ANY(%s);', (terms,))
+            df = dict(cur.fetchall())
+        return documents, words, df
+
+    def find_source(self, source):
+        # Return catalog entry of an indexed file received from the given source or None
+        return self._select_file('source = %s AND indexed', (source,))
+
+    def _select_file(self, where, params):
+        select_sql = f'SELECT {", ".join(FILE_FIELDS)} FROM files WHERE {where} ORDER BY created LIMIT 1;'
+        with self._cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute(select_sql, params)
+            entry = cur.fetchone()
+        return None if entry is None else dict(entry)
+
 
 if __name__ == '__main__':
     import yaml
@@ -0,0 +1,92 @@
+import threading
+import time
+
+PRIORITY_LOW = 0            # Room chatter
+PRIORITY_HIGH = 1           # Direct mentions and direct messages
+
+
+class EventBus():
+    # Wakes up the main loop when any event source (Matrix, ingestion, ...) has
+    # something to process. Sources call signal() from any thread.
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._signals = {}          # source -> monotonic time of the first unhandled signal
+        self._listeners = []
+
+    def add_listener(self, listener):
+        # listener(source, priority) is called in the signalling thread on each signal
+        self._listeners.append(listener)
+
+    def signal(self, source: str, priority=PRIORITY_LOW):
+        with self._cond:
+            self._signals.setdefault(source, time.monotonic())
+            self._cond.notify_all()
+        for listener in self._listeners:
+            listener(source, priority)
+
+    def wait(self, timeout=None):
+        # Block until a source signals or timeout (seconds, None for no timeout) expires.
+        # Returns and clears the pending signals as a dictionary source -> time.
+        with self._cond:
+            self._cond.wait_for(lambda: self._signals, timeout)
+            signals = self._signals
+            self._signals = {}
+        return signals
+
+
+INBOUND_MAX = 50            # Maximum number of queued events
+INBOUND_BODY_MAX = 4000     # Maximum length of coalesced message
+
+
+class InboundQueue():
+    # Bounded, thread-safe queue of received messages (dictionaries with at least 'sender',
+    # 'body', and 'file'). Consecutive text messages from the same sender are coalesced
+    # into one, and on overflow the oldest event with the lowest priority is dropped.
+    def __init__(self, max_size=INBOUND_MAX):
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._items = []            # (priority, sequence number, event)
+        self._seq = 0
+        self._dropped = {}          # sender -> number of dropped events not yet reported
+        self._stats = { 'received': 0, 'coalesced': 0, 'dropped': 0 }
+
+    def put(self, event, priority=PRIORITY_LOW):
+        with self._lock:
+            self._stats['received'] += 1
+            if self._items and not event['file'] and not event.get('error'):
+                p, n, last = self._items[-1]
+                if (last['sender'] == event['sender'] and not last['file'] and not last.get('error') and
+                    len(last['body']) + len(event['body']) < INBOUND_BODY_MAX):
+                    last['body'] += '\n' + event['body']
+                    self._items[-1] = (max(p, priority), n, last)
+                    self._stats['coalesced'] += 1
+                    return
+            self._items.append((priority, self._seq, event))
+            self._seq += 1
+            if len(self._items) > self._max_size:
+                drop = min(self._items, key=lambda i: (i[0], i[1]))
+                self._items.remove(drop)
+                sender = drop[2]['sender']
+                self._dropped[sender] = self._dropped.get(sender, 0) + 1
+                self._stats['dropped'] += 1
+
+    def get(self, max_items=None):
+        # Remove and return at most max_items events, higher priority first, otherwise in order
+        with self._lock:
+            items = sorted(self._items, key=lambda i: (-i[0], i[1]))
+            if max_items is not None:
+                items = items[:max_items]
+            for i in items:
+                self._items.remove(i)
+        return [ i[2] for i in items ]
+
+    def take_dropped(self):
+        # Return and clear numbers of dropped events by sender
+        with self._lock:
+            dropped = self._dropped
+            self._dropped = {}
+        return dropped
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, depth=len(self._items))
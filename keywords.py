@@ -0,0 +1,113 @@
+import math
+import re
+
+KEYWORDS_MAX = 9            # Maximum number of keywords to extract
+PHRASE_MAX_WORDS = 3        # Maximum number of words in a keyword phrase
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Words which never start, end, or are part of a keyword phrase
+STOPWORDS = set('''
+a about above after again against all also am an and any are as at be because been before being below
+between both but by can could did do does doing down during each either else etc ever every few for from
+further had has have having he her here hers herself him himself his how however i if in into is it its
+itself just like may me might more most must my myself no nor not now of off on once only or other our
+ours ourselves out over own same shall she should so some such than that the their theirs them themselves
+then there these they this those through thus to too under until up upon us very was we were what when
+where which while who whom why will with within without would yet you your yours yourself yourselves
+use used uses using via eg ie get gets got make makes made need needs want wants one two much many
+well even still already always never often usually really actually simply new way ways thing things
+i'm i've i'd you're we're they're it's that's there's let's don't doesn't didn't can't isn't aren't won't
+ei eli ja jo jos kun kuin mutta myös niin nyt ole oli olla on ovat se sekä sen siis tai tämä että joka
+mikä mitä hän he me te ne sitä tätä jotka ollut olisi
+'''.split())
+
+WORD_RE = re.compile(r"\w+(?:['’-]\w+)*")
+PHRASE_SPLIT_RE = re.compile(r'[.,;:!?()\[\]{}<>"“”«»|/\\=+*#\n\t]+')
+
+
+def words(text: str):
+    # Return lowercase words of the text, numbers excluded
+    return [ w for w in WORD_RE.findall(text.lower()) if not w.isdigit() ]
+
+def phrases(text: str):
+    # Split text into candidate phrases (RAKE): sequences of words delimited by
+    # punctuation or stopwords. Returns list of lists of (word, lowercase word).
+    candidates = []
+    for part in PHRASE_SPLIT_RE.split(text):
+        phrase = []
+        for w in WORD_RE.findall(part):
+            wl = w.lower()
+            if wl in STOPWORDS or wl.isdigit() or len(wl) < 2:
+                if phrase:
+                    candidates.append(phrase)
+                phrase = []
+                continue
+            phrase.append((w, wl))
+            if len(phrase) == PHRASE_MAX_WORDS:
+                candidates.append(phrase)
+                phrase = []
+        if phrase:
+            candidates.append(phrase)
+    return candidates
+
+
+class KeywordExtractor():
+    # Extracts keywords without LLM by scoring RAKE candidate phrases with word
+    # co-occurrence degrees and BM25 weights. Document frequencies of the words
+    # are maintained incrementally in the database over all indexed chunks.
+    def __init__(self, db, max_keywords=KEYWORDS_MAX):
+        self._db = db
+        self._max_keywords = max_keywords
+
+    def add_document(self, text: str):
+        # Update corpus statistics with a new document (chunk)
+        w = words(text)
+        if w:
+            self._db.add_terms(set(w), len(w))
+
+    def extract(self, text: str, max_keywords: int = None):
+        max_keywords = max_keywords or self._max_keywords
+        candidates = phrases(text)
+        if not candidates:
+            return []
+
+        # RAKE statistics: word frequency and degree (co-occurrences within phrases)
+        freq = {}
+        degree = {}
+        for phrase in candidates:
+            for _, wl in phrase:
+                freq[wl] = freq.get(wl, 0) + 1
+                degree[wl] = degree.get(wl, 0) + len(phrase)
+
+        # BM25 term weights from corpus statistics
+        documents, total_words, df = self._db.get_terms(list(freq.keys()))
+        doc_len = len(words(text))
+        avg_len = total_words / documents if documents else doc_len
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_len / max(avg_len, 1))
+        score = {}
+        for wl, tf in freq.items():
+            n = df.get(wl, 0)
+            idf = math.log((documents - n + 0.5) / (n + 0.5) + 1)
+            bm25 = idf * tf * (BM25_K1 + 1) / (tf + norm)
+            score[wl] = bm25 * degree[wl] / tf
+
+        # Score phrases, keeping the best scoring form of each distinct phrase
+        best = {}
+        for phrase in candidates:
+            key = ' '.join(wl for _, wl in phrase)
+            s = sum(score[wl] for _, wl in phrase) / math.sqrt(len(phrase))
+            if key not in best or s > best[key][0]:
+                best[key] = (s, ' '.join(w for w, _ in phrase), { wl for _, wl in phrase })
+
+        # Select top phrases, skipping the ones whose words are already covered
+        keywords = []
+        covered = set()
+        for s, phrase, ws in sorted(best.values(), key=lambda b: -b[0]):
+            if ws <= covered:
+                continue
+            keywords.append(phrase)
+            covered |= ws
+            if len(keywords) >= max_keywords:
+                break
+        return keywords
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+# Local stand-in for an OpenAI-compatible LLM server (llama-server or LiteLLM).
+# Replays responses recorded to cassettes (config llm_record), and answers other
+# requests with synthetic completions, embeddings and reranks. The synthetic agent
+# answers each user message with send_message() and then sleeps, so the whole bot
+# can be run and benchmarked without GPU or network.
+
+import argparse
+import hashlib
+import json
+import math
+import re
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cassette
+import keywords
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--host', default='127.0.0.1')
+parser.add_argument('--port', type=int, default=4001)
+parser.add_argument('--cassette', action='append', default=[], help='Cassette file to replay (can be repeated)')
+parser.add_argument('--strict', action='store_true', help='Fail requests not found in cassettes')
+parser.add_argument('--speed', type=float, default=1.0, help='Replay speed, 0 for no delays')
+parser.add_argument('--latency', type=float, default=0.05, help='Synthetic time to first token (seconds)')
+parser.add_argument('--prompt-latency', type=float, default=0.00005, help='Synthetic prompt processing time per character')
+parser.add_argument('--token-latency', type=float, default=0.01, help='Synthetic time per generated token')
+parser.add_argument('--embedding-latency', type=float, default=0.005, help='Synthetic time per embedding')
+parser.add_argument('--embedding-dimensions', type=int, default=1024)
+parser.add_argument('--slots', type=int, default=4, help='Number of slots reported by /slots')
+args = parser.parse_args()
+
+records = {}
+for pathname in args.cassette:
+    for key, r in cassette.Cassette(pathname).load().items():
+        records.setdefault(key, []).extend(r)
+replayed = {}                       # key -> number of times replayed
+lock = threading.Lock()
+stats = { 'requests': 0, 'replayed': 0, 'synthetic': 0, 'paths': {} }
+
+
+def sleep(seconds):
+    if seconds > 0:
+        time.sleep(seconds)
+
+def text_of(content):
+    if isinstance(content, str):
+        return content
+    return ' '.join(c.get('text', '') for c in content if c.get('type') == 'text')
+
+def synthetic_completion(messages):
+    # Deterministic answer depending on the kind of the request
+    last = text_of(messages[-1]['content']) if messages else ''
+    if messages and '## Functions' in text_of(messages[0]['content']):
+        # Agent dialogue: answer the latest user messages, then sleep
+        m = re.findall(r'<message user="([^"]*)"[^>]*>(.*?)</message>', last, re.DOTALL)
+        if not m:
+            return 'Nothing new.\n```python\nsleep()\n```'
+        reply = ' / '.join(body.strip()[:100] for _, body in m)
+        return f'Answering {m[-1][0]}.\n```python\nsend_message({json.dumps("Got: " + reply)})\nsleep()\n```'
+    previous = next((text_of(m['content']) for m in reversed(messages) if m['role'] == 'assistant'), last)
+    if 'keywords' in last.lower():
+        counts = {}
+        for w in keywords.words(previous):
+            if w not in keywords.STOPWORDS and len(w) > 2:
+                counts[w] = counts.get(w, 0) + 1
+        return ', '.join(sorted(counts, key=lambda w: -counts[w])[:keywords.KEYWORDS_MAX])
+    # Summary: the first quarter of the text
+    words = previous.split()
+    return ' '.join(words[:max(1, len(words) // 4)])
+
+def synthetic_embedding(text):
+    # Unit vector from hashes of the words: texts sharing words have similar embeddings
+    v = [ 0.0 ] * args.embedding_dimensions
+    for w in keywords.words(text) or [ '' ]:
+        h = hashlib.blake2b(w.encode('utf-8'), digest_size=8).digest()
+        i, sign = struct.unpack('<IH', h[:6])
+        v[i % len(v)] += 1.0 if sign & 1 else -1.0
+    norm = math.sqrt(sum(x * x for x in v)) or 1.0
+    return [ x / norm for x in v ]
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *a):
+        pass
+
+    def _json(self, obj, status=200):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _chunk(self, data):
+        # One HTTP chunk containing one server-sent event
+        event = b'data: ' + data.encode('utf-8') + b'\n\n'
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(event), event))
+        self.wfile.flush()
+
+    def _stream(self, chunks, start):
+        # chunks: list of (seconds from start, data)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for t, data in chunks:
+            sleep(start + t - time.monotonic())
+            self._chunk(data)
+        self.wfile.write(b'0\r\n\r\n')
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._json({ 'status': 'ok' })
+        elif self.path == '/slots':
+            self._json([ { 'id': i } for i in range(args.slots) ])
+        elif self.path == '/stats':
+            with lock:
+                self._json(stats)
+        else:
+            self._json({ 'error': 'not found' }, 404)
+
+    def do_POST(self):
+        start = time.monotonic()
+        payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        path = self.path.split('?')[0]
+        with lock:
+            stats['requests'] += 1
+            stats['paths'][path] = stats['paths'].get(path, 0) + 1
+        if path.startswith('/slots/'):
+            return self._json({ 'id_slot': int(path.split('/')[2]), 'n_saved': 0, 'n_restored': 0 })
+
+        # Replay from a cassette, cycling through the records of the same request
+        key = cassette.request_key(path, payload)
+        if key in records:
+            with lock:
+                n = replayed.get(key, 0)
+                replayed[key] = n + 1
+                stats['replayed'] += 1
+            r = records[key][n % len(records[key])]
+            speed = args.speed or float('inf')
+            if 'chunks' in r:
+                return self._stream([ (t / speed, d) for t, d in r['chunks'] ], start)
+            sleep(r['latency'] / speed)
+            return self._json(r['response'], r['status'])
+        if args.strict:
+            return self._json({ 'error': 'request not in cassettes' }, 404)
+        with lock:
+            stats['synthetic'] += 1
+
+        model = payload.get('model', 'standin')
+        if path == '/v1/chat/completions':
+            messages = payload.get('messages', [])
+            prompt_chars = sum(len(text_of(m['content'])) for m in messages)
+            content = synthetic_completion(messages)
+            tokens = re.findall(r'\s*\S+|\s+', content)
+            usage = { 'prompt_tokens': prompt_chars // 4, 'completion_tokens': len(tokens),
+                      'total_tokens': prompt_chars // 4 + len(tokens) }
+            first = args.latency + args.prompt_latency * prompt_chars
+            if not payload.get('stream'):
+                sleep(first + args.token_latency * len(tokens))
+                return self._json({ 'model': model, 'usage': usage,
+                    'choices': [ { 'index': 0, 'finish_reason': 'stop',
+                                   'message': { 'role': 'assistant', 'content': content } } ] })
+            chunks = [ (first + args.token_latency * i, json.dumps({ 'model': model,
+                'choices': [ { 'index': 0, 'delta': { 'content': t } } ] })) for i, t in enumerate(tokens) ]
+            end = first + args.token_latency * len(tokens)
+            chunks.append((end, json.dumps({ 'model': model, 'choices': [], 'usage': usage })))
+            chunks.append((end, '[DONE]'))
+            return self._stream(chunks, start)
+        if path == '/v1/embeddings':
+            inputs = payload.get('input', '')
+            inputs = [ inputs ] if isinstance(inputs, str) else inputs
+            sleep(args.embedding_latency * len(inputs))
+            return self._json({ 'model': model, 'data': [ { 'index': i, 'embedding': synthetic_embedding(t) }
+                                                          for i, t in enumerate(inputs) ] })
+        if path == '/v1/rerank':
+            query = set(keywords.words(payload.get('query', '')))
+            documents = payload.get('documents', [])
+            sleep(args.embedding_latency * len(documents))
+            return self._json({ 'model': model, 'results': [ { 'index': i,
+                'relevance_score': len(query & set(keywords.words(d))) / (len(query) or 1) }
+                for i, d in enumerate(documents) ] })
+        if path == '/utils/token_counter':
+            return self._json({ 'total_tokens': len(payload.get('prompt', '')) // 4 + 1 })
+        self._json({ 'error': 'not found' }, 404)
+
+
+print(f'Stand-in LLM server at http://{args.host}:{args.port}, {sum(len(r) for r in records.values())} recorded responses')
+ThreadingHTTPServer((args.host, args.port), Handler).serve_forever()
@@ -1,11 +1,359 @@
+import collections
+import concurrent.futures
+import heapq
 import json
+import random
 import requests
+import threading
+import time
 import urllib3
 
+import cache
+import cassette
+import metrics
+
+BALANCING = 'least_outstanding'     # Endpoint selection: 'least_outstanding' or 'latency'
+LATENCY_WEIGHT = 0.2        # Weight of a new sample in the moving average of latency
+HEALTH_INTERVAL = 5         # seconds between health checks of a failed endpoint
+POOL_FALLBACK = {           # Pool used when a pool has no endpoints configured
+    'ingestion':        'chat',
+    'token_counter':    'chat',
+}
+
+PRIORITY_BACKGROUND = 0     # Indexing of files
+PRIORITY_INTERACTIVE = 1    # Agent dialogue
+CONCURRENCY_INITIAL = 4     # Initial limit of requests in progress per endpoint
+CONCURRENCY_MAX = 16        # Maximum limit of requests in progress per endpoint
+CONCURRENCY_RESERVED = 1    # Requests kept available for interactive requests
+LATENCY_TOLERANCE = 2.0     # Latency this many times the minimum means queueing in the server
+LATENCY_MIN_SIGNAL = 0.1    # seconds, shorter latencies are not considered queueing
+LATENCY_UNIT = 4096         # Characters of input, latency of larger requests is compared per unit
+DECREASE_OVERLOAD = 0.5     # Multiplier of the limit on 429 or 503 response
+DECREASE_LATENCY = 0.9      # Multiplier of the limit on queueing latency
+STREAM_READ_SIZE = 65536    # Maximum bytes read from a stream at a time
+TIMEOUTS = {                # (connect, read) timeouts in seconds by pool; for streams read
+    'chat':             (10, 300),      # timeout is the maximum time between chunks
+    'ingestion':        (10, 900),
+    'embedding':        (10, 60),
+    'rerank':           (10, 60),
+    'token_counter':    (10, 30),
+}
+RETRIES = 3                 # Retries of idempotent requests (embedding, rerank, token counting)
+BACKOFF_BASE = 0.5          # seconds, maximum delay before the first retry, doubled for each retry
+BACKOFF_MAX = 30            # seconds, maximum delay before a retry
+HEDGE_PERCENTILE = 0.95     # Latency percentile after which a hedged request is sent
+HEDGE_MIN_SAMPLES = 20      # Number of latency samples needed before hedging
+HEDGE_SAMPLES = 200         # Number of latency samples kept per pool
+
+_hedge_executor = concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix='hedge')
+
+REQUESTS = metrics.counter('scrittabot_llm_requests_total', 'HTTP requests to LLM endpoints by pool and status', ( 'pool', 'status' ))
+RESPONSE_SECONDS = metrics.histogram('scrittabot_llm_response_seconds', 'Time to response headers by pool', ( 'pool', ))
+CALL_SECONDS = metrics.histogram('scrittabot_llm_call_seconds',
+    'Duration of LLM calls by pool, for streams until the end, with retries', ( 'pool', ))
+TTFT_SECONDS = metrics.histogram('scrittabot_llm_ttft_seconds', 'Time to first token of streamed completions', ( 'pool', ))
+TOKENS = metrics.counter('scrittabot_llm_tokens_total', 'Tokens processed by LLM endpoints by pool and kind', ( 'pool', 'kind' ))
+CACHE_RESULTS = metrics.counter('scrittabot_llm_cache_total', 'Cacheable requests answered from the cache (hit) or not (miss)', ( 'result', ))
+
+
+def sse_data(chunks):
+    # Incremental parser of a server-sent events stream given as chunks of bytes.
+    # Yields the data of each "data:" line as bytes. Lines are located in one buffer,
+    # without splitting the stream into lines or decoding them.
+    buf = bytearray()
+    for chunk in chunks:
+        buf += chunk
+        start = 0
+        with memoryview(buf) as view:           # Data is copied once, from the view
+            while (end := buf.find(b'\n', start)) != -1:
+                if buf.startswith(b'data:', start):
+                    begin = start + 5
+                    if begin < end and buf[begin] == 32:                 # Space after colon
+                        begin += 1
+                    stop = end - 1 if end > begin and buf[end - 1] == 13 else end    # \r\n
+                    yield bytes(view[begin:stop])
+                # Other lines (empty lines between events, comments, event types) are ignored
+                start = end + 1
+        del buf[:start]                         # The buffer can be resized after the view is released
+    if buf.startswith(b'data:'):
+        yield bytes(buf[5:]).strip()
+
+def stream_chunks(response, size=STREAM_READ_SIZE):
+    # Yield the body of a streamed response in chunks as soon as they arrive
+    # (iter_content() may wait until a chunk of the given size has been received)
+    raw = response.raw
+    if hasattr(raw, 'read1'):       # urllib3 2.3 or newer
+        while chunk := raw.read1(size, decode_content=True):
+            yield chunk
+    else:
+        yield from response.iter_content(chunk_size=None)
+
+def record_usage(pool, usage):
+    # Count the tokens of a response (usage of the OpenAI API)
+    for kind in ( 'prompt', 'completion' ):
+        if usage.get(f'{kind}_tokens'):
+            TOKENS.inc(usage[f'{kind}_tokens'], pool=pool, kind=kind)
+
+def input_units(payload):
+    # Size of the input texts of an embedding, rerank, or token counting request
+    # in LATENCY_UNITs, at least 1
+    size = 0
+    for k in ( 'input', 'query', 'documents', 'prompt' ):
+        v = payload.get(k)
+        for t in [ v ] if isinstance(v, str) else v or []:
+            if isinstance(t, str):
+                size += len(t)
+    return max(1.0, size / LATENCY_UNIT)
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(p * len(sorted_values)))]
+
+
+class Slots():
+    # llama-server slots of one server, shared by the Endpoints of all pools using it
+    def __init__(self, url):
+        self.url = url
+        self.reserved = set()       # Slots pinned to an Llm object
+        self._count = None          # Number of slots, 0 if not available
+        self._busy = {}             # slot -> requests in progress
+        self._lock = threading.Lock()
+
+    def take(self, headers, verify):
+        # Return the least busy slot which is not pinned, or None
+        if self._count is None:
+            try:
+                response = requests.get(self.url + '/slots', headers=headers, timeout=HEALTH_INTERVAL, verify=verify)
+                response.raise_for_status()
+                self._count = len(response.json())
+            except (requests.exceptions.RequestException, ValueError, TypeError):
+                self._count = 0
+                print(f'LLM endpoint {self.url} has no slots information, not using slots')
+        with self._lock:
+            free = [ s for s in range(self._count) if s not in self.reserved ]
+            if not free:
+                return None
+            slot = min(free, key=lambda s: self._busy.get(s, 0))
+            self._busy[slot] = self._busy.get(slot, 0) + 1
+            return slot
+
+    def release(self, slot):
+        with self._lock:
+            self._busy[slot] -= 1
+
+class Endpoint():
+    # One server (replica) used by one pool. Shared by all Llm objects using the same
+    # URL for the pool, so that the load of the server is known over all users.
+    # The number of requests in progress is limited adaptively (AIMD): the limit grows
+    # by one per round of successful requests, and is cut when the server responds
+    # with 429/503 or latency grows above the observed minimum (requests are queued
+    # in the server). Waiting requests are started in priority order.
+    def __init__(self, url, max_concurrency=CONCURRENCY_MAX, slots=None):
+        self.url = url
+        self.slots = slots or Slots(url)
+        self.outstanding = 0        # Requests in progress
+        self.latency = None         # Moving average of time to response headers, for streams
+                                    # to the first token (seconds)
+        self.healthy = True
+        self.requests = 0
+        self.failures = 0
+        self.overloads = 0
+        self.limit = float(min(CONCURRENCY_INITIAL, max_concurrency))
+        self.max_limit = max_concurrency
+        self._min_latency = {}      # kind of request -> minimum latency
+        self._decreased = 0         # Time of the last decrease of the limit
+        self._waiting = []          # Heap of (-priority, sequence number)
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._checking = False
+
+    def load(self, balancing):
+        # Smaller is better. Endpoints without latency samples are tried first.
+        queued = self.outstanding + len(self._waiting)
+        if balancing == 'latency':
+            return ((queued + 1) * (self.latency or 0) / self.limit, queued)
+        return (queued / self.limit, self.latency or 0)
+
+    def _available(self, priority):
+        limit = int(self.limit)
+        if priority < PRIORITY_INTERACTIVE and limit > CONCURRENCY_RESERVED:
+            limit -= CONCURRENCY_RESERVED
+        return self.outstanding < limit
+
+    def start(self, priority=PRIORITY_BACKGROUND):
+        # Wait until the request can be sent
+        with self._cond:
+            self._seq += 1
+            me = (-priority, self._seq)
+            heapq.heappush(self._waiting, me)
+            self._cond.wait_for(lambda: self._waiting[0] == me and self._available(priority))
+            heapq.heappop(self._waiting)
+            self.outstanding += 1
+            self.requests += 1
+            self._cond.notify_all()
+
+    def done(self):
+        with self._cond:
+            self.outstanding -= 1
+            self._cond.notify_all()
+
+    def _decrease(self, factor):
+        now = time.monotonic()
+        # At most once per round trip, a burst of responses is one congestion signal
+        if now - self._decreased > (self.latency or 0):
+            self.limit = max(1.0, self.limit * factor)
+            self._decreased = now
+
+    def success(self, latency, kind=None, units=1.0):
+        # kind identifies requests with comparable latency (None if latency depends on
+        # the length of the response), only they are used to detect queueing. Their
+        # latency per unit of input size is compared to the minimum.
+        with self._cond:
+            self.healthy = True
+            self._average(latency)
+            unit_latency = min_latency = latency / units
+            if kind is not None:
+                min_latency = min(self._min_latency.get(kind, unit_latency), unit_latency)
+                self._min_latency[kind] = min_latency
+            if latency > LATENCY_MIN_SIGNAL and unit_latency > LATENCY_TOLERANCE * min_latency:
+                self._decrease(DECREASE_LATENCY)
+            elif self.outstanding >= int(self.limit) - 1:
+                self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    def streaming(self):
+        # Response headers of a stream received
+        with self._cond:
+            self.healthy = True
+
+    def first_token(self, latency):
+        # Time to first token of a stream. It depends on how much of the prompt is cached,
+        # so it updates only the latency estimate, not the limit.
+        with self._cond:
+            self._average(latency)
+
+    def _average(self, latency):
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += LATENCY_WEIGHT * (latency - self.latency)
+
+    def overload(self):
+        # Server responded with 429 or 503
+        with self._cond:
+            self.overloads += 1
+            self._decrease(DECREASE_OVERLOAD)
+
+    def fail(self, headers, verify):
+        # Mark the endpoint unhealthy until a health check succeeds
+        with self._lock:
+            self.failures += 1
+            self.healthy = False
+            if self._checking:
+                return
+            self._checking = True
+        threading.Thread(target=self._health_check, args=(headers, verify), name='health', daemon=True).start()
+
+    def _health_check(self, headers, verify):
+        while True:
+            time.sleep(HEALTH_INTERVAL)
+            try:
+                # Any response which is not a server error means that the server is up
+                response = requests.get(self.url + '/health', headers=headers, timeout=HEALTH_INTERVAL, verify=verify)
+                if response.status_code < 500:
+                    break
+            except requests.exceptions.RequestException:
+                pass
+        with self._lock:
+            self.healthy = True
+            self._checking = False
+        print(f'LLM endpoint {self.url} is up')
+
+_endpoints = {}            # (pool, url) -> Endpoint
+_slots = {}                # url -> Slots
+_endpoints_lock = threading.Lock()
+
+def endpoint(url, max_concurrency=CONCURRENCY_MAX, pool='chat'):
+    # Return the shared Endpoint object for the URL used by the pool. Each pool has its own
+    # request limit also when pools share a server: a streamed completion can wait for tools
+    # using the same server, which must not wait for its request slot.
+    url = url.rstrip('/')
+    with _endpoints_lock:
+        if (pool, url) not in _endpoints:
+            if url not in _slots:
+                _slots[url] = Slots(url)
+            _endpoints[(pool, url)] = Endpoint(url, max_concurrency, _slots[url])
+        return _endpoints[(pool, url)]
+
+def endpoint_stats():
+    with _endpoints_lock:
+        return { f'{pool} {url}': {
+            'outstanding':  e.outstanding,
+            'waiting':      len(e._waiting),
+            'limit':        e.limit,
+            'requests':     e.requests,
+            'failures':     e.failures,
+            'overloads':    e.overloads,
+            'latency':      e.latency,
+            'healthy':      e.healthy,
+        } for (pool, url), e in _endpoints.items() }
+
+
+def config_options(config):
+    # Keyword arguments of Llm from the configuration, common to all users
+    return {
+        'endpoints':        config.get('endpoints'),
+        'balancing':        config.get('endpoint_balancing', BALANCING),
+        'max_concurrency':  config.get('endpoint_max_concurrency', CONCURRENCY_MAX),
+        'cache':            cache.open_cache(config['llm_cache'], config.get('llm_cache_size', cache.CACHE_MAX_SIZE))
+                            if config.get('llm_cache') else None,
+        'timeouts':         config.get('llm_timeouts'),
+        'retries':          config.get('llm_retries', RETRIES),
+        'hedge':            config.get('llm_hedge', False),
+        'cassette':         cassette.open_cassette(config['llm_record']) if config.get('llm_record') else None,
+    }
+
 
 class Llm:
-    def __init__(self, url, api_key=None, options={}, embedding_query='', insecure=False):
+    # endpoints is an optional dictionary of pools ('chat', 'ingestion', 'embedding',
+    # 'rerank', 'token_counter') and their URLs (a string or a list of replicas).
+    # Pools without endpoints use url. Completions are sent to the given pool, and all
+    # requests wait for a free request slot of the endpoint with the given priority.
+    # With llama-server, completions can be pinned to a slot, so that its KV cache is
+    # kept for this object, or with slots spread over the slots which are not pinned.
+    # Responses of deterministic requests are stored in cache (cache.ResponseCache) if given.
+    # timeouts overrides TIMEOUTS by pool. Idempotent requests are retried, and with hedge
+    # a slow request is also sent to another endpoint of the pool. Requests and responses
+    # are recorded to cassette (cassette.Cassette) if given.
+    def __init__(self, url, api_key=None, options={}, embedding_query='', insecure=False,
+                 endpoints=None, pool='chat', balancing=BALANCING,
+                 priority=PRIORITY_BACKGROUND, max_concurrency=CONCURRENCY_MAX,
+                 slot=None, slots=False, cache=None, timeouts=None, retries=RETRIES, hedge=False,
+                 cassette=None):
         self._base_url = url
+        self._cache = cache
+        self._cassette = cassette
+        self._timeouts = dict(TIMEOUTS, **{ k: tuple(v) for k, v in (timeouts or {}).items() })
+        self._retries = retries
+        self._hedge = hedge
+        self._latencies = collections.defaultdict(lambda: collections.deque(maxlen=HEDGE_SAMPLES))
+        self.hedge_stats = { 'hedged': 0, 'hedge_won': 0, 'retries': 0 }
+        self._max_concurrency = max_concurrency
+        self._pools = {}
+        for name, urls in (endpoints or {}).items():
+            urls = [ urls ] if isinstance(urls, str) else urls
+            self._pools[name] = [ u.rstrip('/') for u in urls ]
+        self._pool_name = pool
+        self._balancing = balancing
+        self._priority = priority
+        self._slot = slot
+        self._slots = slots
+        self._affinity = None       # Endpoint which has the KV cache of the pinned slot
+        if slot is not None:
+            for e in self._pool(pool):
+                e.slots.reserved.add(slot)
         self._api_key = api_key
         self._options = options
         self._insecure = insecure
@@ -32,6 +380,7 @@ class Llm:
             'model': None,
             'usage': {},
             'timings': {},          # timings not available through LiteLLM
+            'client': {},           # Measured by the client (streaming only)
         }
 
     def _parse_stats(self, chunk):
@@ -39,6 +388,185 @@ class Llm:
             if k in chunk:
                 self._stats[k] = chunk[k]
 
+    def _pool(self, name):
+        # Endpoints of the pool, with the URLs of the fallback pool if it has none
+        urls_from = name
+        while urls_from not in self._pools and urls_from in POOL_FALLBACK:
+            urls_from = POOL_FALLBACK[urls_from]
+        urls = self._pools.get(urls_from) or [ self._base_url ]
+        return [ endpoint(u, self._max_concurrency, name) for u in urls ]
+
+    def _timeout(self, pool):
+        while pool not in self._timeouts and pool in POOL_FALLBACK:
+            pool = POOL_FALLBACK[pool]
+        return self._timeouts.get(pool, TIMEOUTS['chat'])
+
+    def _post(self, path, payload, pool, stream=False, avoid=None):
+        # POST to the least loaded healthy endpoint of the pool. On connection errors,
+        # server errors, and overload the request is sent to the next endpoint.
+        # Completions with a pinned slot go to the same endpoint as before when possible.
+        # Endpoints in the list avoid are not used if possible, and the chosen endpoints
+        # are appended to it.
+        # Returns (response, done); with stream the caller must call done() after reading,
+        # with the time.monotonic() of the first token if there was one.
+        candidates = list(self._pool(pool))
+        if avoid is not None:
+            candidates = [ c for c in candidates if c not in avoid ] or candidates
+        completion = path == '/v1/chat/completions'
+        headers = dict(self._session.headers)
+        while True:
+            healthy = [ c for c in candidates if c.healthy ] or candidates
+            if completion and self._slot is not None and self._affinity in healthy:
+                e = self._affinity
+            else:
+                e = min(healthy, key=lambda c: c.load(self._balancing))
+            candidates.remove(e)
+            if avoid is not None:
+                avoid.append(e)
+            e.start(self._priority)
+            slot = None
+            if completion and self._slot is not None:
+                payload = dict(payload, id_slot=self._slot)
+            elif completion and self._slots:
+                slot = e.slots.take(headers, not self._insecure)
+                if slot is not None:
+                    payload = dict(payload, id_slot=slot)
+
+            start = time.monotonic()
+
+            def done(first_token=None, e=e, slot=slot, start=start):
+                if first_token is not None:
+                    e.first_token(first_token - start)
+                e.done()
+                if slot is not None:
+                    e.slots.release(slot)
+
+            try:
+                response = self._session.post(e.url + path, json=payload, stream=stream,
+                    timeout=self._timeout(pool), verify=not self._insecure)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as ex:
+                REQUESTS.inc(pool=pool, status='error')
+                done()
+                e.fail(headers, not self._insecure)
+                if not candidates:
+                    raise
+                print(f'LLM endpoint {e.url} failed ({ex}), trying another')
+                continue
+            REQUESTS.inc(pool=pool, status=response.status_code)
+            RESPONSE_SECONDS.observe(time.monotonic() - start, pool=pool)
+            if response.status_code >= 500 or response.status_code == 429:
+                if response.status_code in ( 429, 503 ):
+                    e.overload()
+                else:
+                    e.fail(headers, not self._insecure)
+                if candidates:
+                    print(f'LLM endpoint {e.url} returned {response.status_code}, trying another')
+                    response.close()
+                    done()
+                    continue
+            else:
+                if stream:
+                    e.streaming()           # Latency is known when the first token arrives
+                else:
+                    # Time to headers of a completion includes generating the response
+                    kind = None if path.endswith('/completions') else path
+                    e.success(time.monotonic() - start, kind, input_units(payload))
+                    self._latencies[pool].append(time.monotonic() - start)
+                if completion and self._slot is not None:
+                    self._affinity = e
+            if not stream:
+                done()
+            return response, done
+
+    def _request(self, path, payload, pool, field):
+        # POST and return the JSON response. Deterministic requests are answered from
+        # the cache if possible, and responses containing field are stored in it.
+        key = None
+        if self._cache is not None and (path != '/v1/chat/completions' or
+            (payload.get('temperature', 1.0) == 0 and payload.get('n', 1) == 1 and not payload.get('stream'))):
+            key = cache.key(path, payload)
+            response = self._cache.get(key)
+            CACHE_RESULTS.inc(result='miss' if response is None else 'hit')
+            if response is not None:
+                if self._cassette is not None:
+                    # Recorded as an instant response, so that recordings with a warm cache can be replayed
+                    self._cassette.record(path, payload, 200, 0.0, response=response)
+                return response
+        start = time.monotonic()
+        if path == '/v1/chat/completions':
+            response, _ = self._post(path, payload, pool)
+        else:
+            response = self._post_retry(path, payload, pool)
+        response.raise_for_status()  # Raise an exception for bad status codes (4xx or 5xx)
+        elapsed = response.elapsed.total_seconds()
+        response = response.json()
+        CALL_SECONDS.observe(time.monotonic() - start, pool=pool)
+        record_usage(pool, response.get('usage') or {})
+        if self._cassette is not None:
+            self._cassette.record(path, payload, 200, elapsed, response=response)
+        if key is not None and field in response:
+            self._cache.put(key, response)
+        return response
+
+    def _post_retry(self, path, payload, pool):
+        # POST an idempotent request, retrying on errors with jittered exponential backoff
+        for attempt in range(self._retries + 1):
+            last = attempt == self._retries
+            try:
+                response = self._post_hedged(path, payload, pool) if self._hedge else self._post(path, payload, pool)[0]
+                if (response.status_code < 500 and response.status_code != 429) or last:
+                    return response
+                reason = f'status {response.status_code}'
+                retry_after = response.headers.get('Retry-After', '')
+                response.close()
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if last:
+                    raise
+                reason = str(e)
+                retry_after = ''
+            delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+            if retry_after.isdigit():
+                delay = max(delay, min(BACKOFF_MAX, int(retry_after)))
+            self.hedge_stats['retries'] += 1
+            print(f'LLM {path} failed ({reason}), retrying in {delay:.1f}s')
+            time.sleep(delay)
+
+    def _post_hedged(self, path, payload, pool):
+        # If there is no response within the usual (HEDGE_PERCENTILE) latency of the pool,
+        # send the same request to another endpoint and use the response which comes first.
+        samples = sorted(self._latencies[pool])
+        if len(self._pool(pool)) < 2 or len(samples) < HEDGE_MIN_SAMPLES:
+            return self._post(path, payload, pool)[0]
+        avoid = []
+        first = _hedge_executor.submit(self._post, path, payload, pool, False, avoid)
+        try:
+            return first.result(timeout=percentile(samples, HEDGE_PERCENTILE))[0]
+        except concurrent.futures.TimeoutError:
+            pass
+        self.hedge_stats['hedged'] += 1
+        second = _hedge_executor.submit(self._post, path, payload, pool, False, list(avoid))
+        pending = { first, second }
+        while True:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for f in done:
+                if f.exception() is None or not pending:
+                    if f is second and f.exception() is None:
+                        self.hedge_stats['hedge_won'] += 1
+                    return f.result()[0]
+
+    def slot_action(self, action, filename):
+        # Save ('save') or restore ('restore') the KV cache of the pinned slot to or from
+        # a file in the directory given to llama-server with --slot-save-path
+        e = self._affinity or self._pool(self._pool_name)[0]
+        response = self._session.post(f'{e.url}/slots/{self._slot}?action={action}',
+            json = { 'filename': filename },
+            timeout = self._timeout(self._pool_name),
+            verify = not self._insecure
+        )
+        response.raise_for_status()
+        self._affinity = e
+        return response.json()
+
     def _raise_exception(self, msg, payload, output):
         with open('llm_exception_payload.json', 'w') as f:
             json.dump(payload, f, indent=4)
@@ -51,16 +579,10 @@ class Llm:
         payload = self._options.copy()
         payload['messages'] = messages
 
-        response = self._session.post(
-            self._base_url + '/v1/chat/completions',
-            json = payload,
-            verify = not self._insecure
-        )
         try:
-            response.raise_for_status()  # Raise an exception for bad status codes (4xx or 5xx)
+            response = self._request('/v1/chat/completions', payload, self._pool_name, 'choices')
         except requests.exceptions.HTTPError as e:
-            self._raise_exception(f'HTTPError:{e}', payload, response)
-        response = response.json()
+            self._raise_exception(f'HTTPError:{e}', payload, e.response.text)
         self._parse_stats(response)
 
         if ('choices' in response and
@@ -87,13 +609,7 @@ class Llm:
             for c in content:
                 if c['type'] == 'text':
                     payload['prompt'] = c['text']
-                    response = self._session.post(
-                        self._base_url + '/utils/token_counter',
-                        json = payload,
-                        verify = not self._insecure
-                    )
-                    response.raise_for_status()  # Raise an exception for bad status codes (4xx or 5xx)
-                    tokens += response.json()['total_tokens']
+                    tokens += self._request('/utils/token_counter', payload, 'token_counter', 'total_tokens')['total_tokens']
                 else:
                     # Image
                     tokens += self._tokens_image
@@ -104,94 +620,155 @@ class Llm:
     def embedding(self, string):
         payload = self._options.copy()
         payload['input'] = self._embedding_query + string
-        response = self._session.post(
-            self._base_url + '/v1/embeddings',
-            json = payload,
-            verify = not self._insecure
-        )
-        response.raise_for_status()  # Raise an exception for bad status codes (4xx or 5xx)
-        return response.json()['data'][0]['embedding']
+        return self._request('/v1/embeddings', payload, 'embedding', 'data')['data'][0]['embedding']
 
     def rerank(self, query, chunks):
         payload = self._options.copy()
         payload['query'] = query
         payload['documents'] = chunks
-        response = self._session.post(
-            self._base_url + '/v1/rerank',
-            json = payload,
-            verify = not self._insecure
-        )
-        response.raise_for_status()  # Raise an exception for bad status codes (4xx or 5xx)
-        return [i['relevance_score'] for i in response.json()['results']]
+        response = self._request('/v1/rerank', payload, 'rerank', 'results')
+        return [i['relevance_score'] for i in response['results']]
 
 
 class LlmStreaming(Llm):
-    def __init__(self, url, api_key=None, options={}, embedding_query='', insecure=False):
+    def __init__(self, url, api_key=None, options={}, embedding_query='', insecure=False,
+                 endpoints=None, pool='chat', balancing=BALANCING,
+                 priority=PRIORITY_BACKGROUND, max_concurrency=CONCURRENCY_MAX,
+                 slot=None, slots=False, cache=None, timeouts=None, retries=RETRIES, hedge=False,
+                 cassette=None):
         loc = locals()
         del loc['self']
         del loc['__class__']
         super().__init__(**loc)
+        self._cancel = threading.Event()
+        self._finished = False      # Finish reason received, the completion can not be interrupted
+        self._response = None
+
+    def cancel(self):
+        # Interrupt the completion in progress (from any thread). The completion
+        # generator then ends and cancelled() returns True.
+        if self._finished:
+            return
+        self._cancel.set()
+        response = self._response
+        if response is not None:
+            response.close()
+
+    def cancelled(self):
+        return self._cancel.is_set() and not self._finished
 
     def completion(self, messages):
+        # Returns a generator of the content. Not a generator itself, so that a cancel
+        # left from an earlier completion is cleared now and not when iteration starts.
         self._reset_stats()
+        self._cancel.clear()
+        self._finished = False
+        return self._completion(messages)
+
+    def _completion(self, messages):
+        if self._cancel.is_set():
+            return              # Cancelled before the request was sent
         payload = self._options.copy()
         payload['stream'] = True
         payload['stream_options'] = { 'include_usage': True }     # Required for LiteLLM
         payload['messages'] = messages
 
-        response = self._session.post(
-            self._base_url + '/v1/chat/completions',
-            json = payload,
-            stream = True,
-            verify = not self._insecure
-        )
+        start = time.monotonic()
+        times = []              # Arrival times of the content chunks (tokens)
+        chunks = []             # Data of the stream for the cassette: (seconds from start, data)
+        response, done = self._post('/v1/chat/completions', payload, self._pool_name, stream=True)
         try:
             response.raise_for_status()  # Raise an exception for bad status codes (4xx or 5xx)
         except requests.exceptions.HTTPError as e:
-            self._raise_exception(f'HTTPError:{e}', payload, response)
-
-        iterator = response.iter_lines()
+            done()
+            self._raise_exception(f'HTTPError:{e}', payload, response.text)
 
-        for line_bytes in iterator:
-            line = line_bytes.decode('utf-8').strip()
-            # Standard SSE format: lines start with "data: "
-            if line.startswith('data:'):
-                data_content = line[len('data:'):].strip()
-                if data_content == '[DONE]': # OpenAI-specific end-of-stream marker
-                    response.close()
+        self._response = response
+        try:
+            for data in sse_data(stream_chunks(response)):
+                if self._cancel.is_set() and not self._finished:
+                    return
+                if self._cassette is not None:
+                    chunks.append((time.monotonic() - start, data.decode('utf-8')))
+                if data == b'[DONE]':   # OpenAI-specific end-of-stream marker
                     return
-                chunk = json.loads(data_content)
-                if ('choices' in chunk and
+                chunk = json.loads(data)
+                if chunk.get('choices') and chunk['choices'][0].get('finish_reason'):
+                    self._finished = True
+                if ('choices' in chunk and chunk['choices'] and
                     'delta' in chunk['choices'][0] and
                     'content' in chunk['choices'][0]['delta']):
                     content = chunk['choices'][0]['delta']['content']
                     if not isinstance(content, str):
                         self._raise_exception('bad content (streaming)', payload, chunk)
+                    times.append(time.monotonic())
+                    if len(times) == 1:
+                        self._stats['client'] = { 'ttft': times[0] - start }
                     yield content
                 self._parse_stats(chunk)
-            # Lines that are not "data: ..." or empty lines are typically ignored in SSE
-            # or could be comments (starting with ':')
+        except Exception:
+            if not self._cancel.is_set():
+                raise           # Reading a closed response fails when cancelled
+        finally:
+            self._response = None
+            response.close()
+            done(times[0] if times else None)
+            self._client_stats(start, times)
+            CALL_SECONDS.observe(time.monotonic() - start, pool=self._pool_name)
+            if times:
+                TTFT_SECONDS.observe(times[0] - start, pool=self._pool_name)
+            record_usage(self._pool_name, self._stats['usage'] or {})
+            if self._cassette is not None and chunks and chunks[-1][1] == '[DONE]':     # Complete streams only
+                self._cassette.record('/v1/chat/completions', payload, response.status_code,
+                    response.elapsed.total_seconds(), chunks=chunks)
+
+    def _client_stats(self, start, times):
+        # Timing of the stream measured by the client, available also through LiteLLM
+        gaps = sorted(b - a for a, b in zip(times, times[1:]))
+        tokens = self._stats['usage'].get('completion_tokens') or len(times)
+        decode = times[-1] - times[0] if times else 0
+        self._stats['client'] = {
+            'ttft':                 times[0] - start if times else None,
+            'itl_p50':              percentile(gaps, 0.5),      # Inter-token latency
+            'itl_p90':              percentile(gaps, 0.9),
+            'itl_p99':              percentile(gaps, 0.99),
+            'tokens':               tokens,
+            'tokens_per_second':    (tokens - 1) / decode if decode > 0 else None,
+            'total_time':           time.monotonic() - start,
+        }
 
 class LlmLineStreaming(LlmStreaming):
-    def __init__(self, url, api_key=None, options={}, embedding_query='', insecure=False):
+    def __init__(self, url, api_key=None, options={}, embedding_query='', insecure=False,
+                 endpoints=None, pool='chat', balancing=BALANCING,
+                 priority=PRIORITY_BACKGROUND, max_concurrency=CONCURRENCY_MAX,
+                 slot=None, slots=False, cache=None, timeouts=None, retries=RETRIES, hedge=False,
+                 cassette=None):
         loc = locals()
         del loc['self']
         del loc['__class__']
         super().__init__(**loc)
 
     def completion(self, messages):
-        line = None
-        for token in super().completion(messages):
-            if line is None:
-                line = ''
-            token_lines = token.split('\n')
-            for l in token_lines[:-1]:
-                line += l
-                yield line
-                line = ''
-            line += token_lines[-1]
-        if line is not None:
-            yield line
+        return self._lines(super().completion(messages))
+
+    def _lines(self, tokens):
+        parts = None            # Pieces of the current line
+        try:
+            for token in tokens:
+                if parts is None:
+                    parts = []
+                if '\n' not in token:
+                    parts.append(token)
+                    continue
+                token_lines = token.split('\n')
+                parts.append(token_lines[0])
+                yield ''.join(parts)
+                yield from token_lines[1:-1]
+                parts = [ token_lines[-1] ]
+        finally:
+            tokens.close()          # Close the stream also if the caller stops early
+        if parts is not None:
+            yield ''.join(parts)
 
 
 # Tests
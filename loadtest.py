@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+
+# End-to-end load test: ScrittaBot runs against a local stand-in Matrix homeserver and
+# llm-standin.py, while simulated users send messages and files to the room. The load
+# grows in steps of users; for each step the message-to-reply latencies, turns per minute,
+# context sizes and context reductions are reported:
+#
+#   python3 loadtest.py --database-url postgresql://bench:pw@localhost/bench --users 1,2,4,8
+#
+# The database is reset: never give the database of the bot. The bot runs in a temporary
+# directory and its output goes to loadtest.log there.
+
+import argparse
+import datetime
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+import yaml
+
+import database
+import llm
+import scrittabot
+
+ROOM_ID = '!loadtest:localhost'
+BOT_USER = '@scrittabot:localhost'
+USERS = '1,2,4,8'           # Numbers of simulated users in the load steps
+DURATION = 60               # seconds per load step
+DRAIN_TIME = 60             # seconds waited for replies after each step
+THINK_TIME = 20             # Mean seconds between messages of a user
+MENTION_RATIO = 0.5         # Messages addressed to the bot by name
+FILE_RATIO = 0.05           # Messages which are text files
+FILE_WORDS = 2000
+CONTEXT_LLM = 16384         # Context size given to the bot, small to cause reductions
+SAMPLE_INTERVAL = 0.2       # seconds between samples of the context size
+WORDS = ( 'meeting report budget server backup deadline invoice release test customer '
+          'update schedule design review network storage contract ticket project plan' ).split()
+
+
+class Homeserver():
+    # Minimal Matrix homeserver with one unencrypted room, implementing the parts of the
+    # client-server API used by ToolSetMatrix: filters, long-polling sync, sending messages,
+    # alias resolution and media download. Simulated users post directly to the room.
+    # A message of the bot is the reply to all user messages received before it.
+    def __init__(self):
+        self._state = []            # State events of the room
+        self._timeline = []         # All events of the room in order
+        self._media = {}            # media id -> (filename, data)
+        self._cond = threading.Condition()
+        self._pending = []          # Times when user messages not yet replied to were sent
+        self.latencies = []         # Message-to-reply latencies (seconds)
+        self.sent = 0               # User messages
+        self.replies = 0            # Messages of the bot
+        self.synced = threading.Event()     # Set after the first sync of the bot
+        self._add('m.room.create', '@admin:localhost', { 'creator': '@admin:localhost' }, '')
+        self._add('m.room.name', '@admin:localhost', { 'name': 'Load test' }, '')
+        self.join(BOT_USER)
+
+    def _add(self, event_type, sender, content, state_key=None):
+        with self._cond:
+            event = {
+                'type':             event_type,
+                'event_id':         f'${len(self._timeline)}:localhost',
+                'sender':           sender,
+                'origin_server_ts': int(time.time() * 1000),
+                'content':          content,
+            }
+            if state_key is not None:
+                event['state_key'] = state_key
+                self._state.append(event)
+            self._timeline.append(event)
+            self._cond.notify_all()
+            return event['event_id']
+
+    def join(self, user):
+        self._add('m.room.member', user, { 'membership': 'join', 'displayname': user[1:].split(':')[0] }, user)
+
+    def send_message(self, user, body):
+        with self._cond:
+            self._pending.append(time.monotonic())
+            self.sent += 1
+            self._add('m.room.message', user, { 'msgtype': 'm.text', 'body': body })
+
+    def send_file(self, user, filename, data):
+        with self._cond:
+            media_id = f'media{len(self._media)}'
+            self._media[media_id] = (filename, data)
+            self._pending.append(time.monotonic())
+            self.sent += 1
+            self._add('m.room.message', user, { 'msgtype': 'm.file', 'body': filename,
+                'url': f'mxc://localhost/{media_id}', 'info': { 'size': len(data), 'mimetype': 'text/plain' } })
+
+    def bot_message(self, event_type, content):
+        now = time.monotonic()
+        with self._cond:
+            self.latencies += [ now - t for t in self._pending ]
+            self._pending = []
+            self.replies += 1
+            return self._add(event_type, BOT_USER, content)
+
+    def pending(self):
+        with self._cond:
+            return len(self._pending)
+
+    def sync(self, since, timeout):
+        # Return the sync response, waiting up to timeout seconds for new events
+        with self._cond:
+            if since is None:
+                # Initial sync: the state of the room without history
+                return { 'next_batch': str(len(self._timeline)), 'rooms': { 'join': { ROOM_ID: {
+                    'state': { 'events': list(self._state) }, 'timeline': { 'events': [], 'limited': False } } } } }
+            since = int(since)
+            self._cond.wait_for(lambda: len(self._timeline) > since, timeout)
+            events = self._timeline[since:]
+            response = { 'next_batch': str(len(self._timeline)) }
+            if events:
+                response['rooms'] = { 'join': { ROOM_ID: { 'timeline': { 'events': events, 'limited': False } } } }
+            return response
+
+    def media(self, media_id):
+        with self._cond:
+            return self._media.get(media_id)
+
+
+class HomeserverHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    homeserver = None
+
+    def log_message(self, format, *a):
+        pass
+
+    def _send(self, body, status=200, content_type='application/json'):
+        if content_type == 'application/json':
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _not_found(self):
+        self._send({ 'errcode': 'M_UNRECOGNIZED', 'error': 'Unrecognized request' }, 404)
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        path = urllib.parse.unquote(url.path).split('/')
+        query = urllib.parse.parse_qs(url.query)
+        if url.path == '/_matrix/client/v3/sync':
+            if 'since' in query:
+                self.homeserver.synced.set()     # The initial sync has been processed
+            self._send(self.homeserver.sync(query.get('since', [ None ])[0], int(query.get('timeout', [ '0' ])[0]) / 1000))
+        elif url.path.startswith('/_matrix/client/v3/directory/room/'):
+            self._send({ 'room_id': ROOM_ID, 'servers': [ 'localhost' ] })
+        elif '/download/' in url.path:
+            # /_matrix/client/v1/media/download/localhost/<id> or /_matrix/media/v3/download/...
+            media = self.homeserver.media(path[path.index('download') + 2])
+            if media is None:
+                return self._not_found()
+            self._send(media[1], content_type='application/octet-stream')
+        else:
+            self._not_found()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path.split('?')[0].endswith('/filter'):
+            self._send({ 'filter_id': '1' })
+        else:
+            self._not_found()
+
+    def do_PUT(self):
+        content = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        path = urllib.parse.unquote(urllib.parse.urlparse(self.path).path).split('/')
+        if len(path) == 9 and path[4] == 'rooms' and path[6] == 'send':
+            self._send({ 'event_id': self.homeserver.bot_message(path[7], content) })
+        else:
+            self._not_found()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_homeserver():
+    homeserver = Homeserver()
+    handler = type('Handler', (HomeserverHandler,), { 'homeserver': homeserver })
+    server = ThreadingHTTPServer(('127.0.0.1', free_port()), handler)
+    threading.Thread(target=server.serve_forever, name='homeserver', daemon=True).start()
+    return homeserver, f'http://127.0.0.1:{server.server_address[1]}'
+
+def start_standin(args):
+    port = free_port()
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'llm-standin.py')
+    process = subprocess.Popen([ sys.executable, script, '--port', str(port),
+        '--latency', str(args.llm_latency), '--token-latency', str(args.token_latency),
+        '--embedding-dimensions', str(database.EMBEDDING_DIMENSIONS) ], stdout=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}'
+    for _ in range(100):
+        try:
+            requests.get(url + '/health', timeout=1)
+            return process, url
+        except requests.exceptions.ConnectionError:
+            time.sleep(0.1)
+    process.kill()
+    raise Exception('llm-standin.py did not start')
+
+
+def user(homeserver, name, rng, args, stop):
+    # One simulated user: messages at random intervals, some of them files
+    while not stop.wait(rng.expovariate(1 / args.think_time)):
+        text = ' '.join(rng.choices(WORDS, k=rng.randint(3, 15)))
+        if rng.random() < args.file_ratio:
+            words = ' '.join(rng.choices(WORDS, k=FILE_WORDS))
+            homeserver.send_file(name, f'notes-{rng.randrange(1 << 30)}.txt', words.encode('utf-8'))
+        elif rng.random() < args.mention_ratio:
+            homeserver.send_message(name, f'scrittabot: {text}?')
+        else:
+            homeserver.send_message(name, text.capitalize() + '.')
+
+def run_bot(bot, errors):
+    # Keep the exception of the bot thread, so that the test fails with it
+    try:
+        bot.run()
+    except BaseException as e:
+        errors.append(e)
+        raise
+
+def check_bot(thread, errors):
+    if not thread.is_alive():
+        raise Exception(f'the bot stopped: {errors[0]!r}' if errors else 'the bot stopped')
+
+def run_step(bot, bot_thread, bot_errors, homeserver, users, args):
+    # Run one load step with the given users, return its results
+    rng = random.Random(args.seed + len(users))
+    stop = threading.Event()
+    sent, replies, latencies = homeserver.sent, homeserver.replies, len(homeserver.latencies)
+    stats = dict(bot.stats)
+    context_sizes = []
+    threads = [ threading.Thread(target=user, args=(homeserver, u, random.Random(rng.random()), args, stop), daemon=True)
+                for u in users ]
+    start = time.monotonic()
+    for t in threads:
+        t.start()
+    while time.monotonic() - start < args.duration:
+        time.sleep(SAMPLE_INTERVAL)
+        check_bot(bot_thread, bot_errors)
+        context_sizes.append(bot.stats['context_size'])
+    stop.set()
+    elapsed = time.monotonic() - start
+    drain = time.monotonic()
+    while homeserver.pending() and time.monotonic() - drain < args.drain_time:
+        time.sleep(SAMPLE_INTERVAL)
+        check_bot(bot_thread, bot_errors)
+    latency = sorted(homeserver.latencies[latencies:])
+    turns = bot.stats['turns'] - stats['turns']
+    completions = bot.stats['completions'] - stats['completions']
+    return {
+        'users':                len(users),
+        'messages':             homeserver.sent - sent,
+        'replies':              homeserver.replies - replies,
+        'unanswered':           homeserver.pending(),
+        'latency_p50':          llm.percentile(latency, 0.5),
+        'latency_p90':          llm.percentile(latency, 0.9),
+        'latency_p99':          llm.percentile(latency, 0.99),
+        'latency_max':          latency[-1] if latency else None,
+        'turns_per_minute':     turns / elapsed * 60,
+        'completions':          completions,
+        'context_size_mean':    (bot.stats['context_tokens'] - stats['context_tokens']) / completions if completions else None,
+        'context_size_max':     max(context_sizes, default=0),
+        'reductions':           bot.stats['reductions'] - stats['reductions'],
+    }
+
+def format_step(r):
+    def s(v):
+        return '-' if v is None else f'{v:.2f}'
+    return (f'users:{r["users"]} messages:{r["messages"]} replies:{r["replies"]} unanswered:{r["unanswered"]} '
+            f'latency p50/p90/p99/max:{s(r["latency_p50"])}/{s(r["latency_p90"])}/{s(r["latency_p99"])}/{s(r["latency_max"])}s '
+            f'turns/min:{r["turns_per_minute"]:.1f} context mean/max:{s(r["context_size_mean"])}/{r["context_size_max"]} '
+            f'reductions:{r["reductions"]}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--database-url', required=True, help='PostgreSQL database (with pgvector) which can be reset')
+    parser.add_argument('--config', help='Configuration file for other settings of the bot')
+    parser.add_argument('--llm-url', help='OpenAI-compatible server instead of llm-standin.py')
+    parser.add_argument('--llm-latency', type=float, default=0.05, help='Time to first token of llm-standin.py')
+    parser.add_argument('--token-latency', type=float, default=0.01, help='Time per token of llm-standin.py')
+    parser.add_argument('--users', default=USERS, help='Numbers of simulated users in the load steps, comma separated')
+    parser.add_argument('--duration', type=float, default=DURATION, help='Seconds per load step')
+    parser.add_argument('--drain-time', type=float, default=DRAIN_TIME, help='Seconds waited for replies after each step')
+    parser.add_argument('--think-time', type=float, default=THINK_TIME, help='Mean seconds between messages of a user')
+    parser.add_argument('--mention-ratio', type=float, default=MENTION_RATIO)
+    parser.add_argument('--file-ratio', type=float, default=FILE_RATIO)
+    parser.add_argument('--context', type=int, default=CONTEXT_LLM, help='Context size of the bot (tokens)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='loadtest.json', help='File for the results')
+    args = parser.parse_args()
+    output_pathname = os.path.abspath(args.output)
+
+    homeserver, homeserver_url = start_homeserver()
+    standin = None
+    if args.llm_url:
+        llm_url = args.llm_url
+    else:
+        standin, llm_url = start_standin(args)
+
+    config = {}
+    if args.config:
+        with open(args.config, 'r') as f:
+            config = yaml.safe_load(f)
+    for k in ( 'endpoints', 'llm_cache', 'llm_record', 'llama_slots' ):
+        config.pop(k, None)         # Never touch the data of the bot
+    config.setdefault('model_llm', 'loadtest')
+    config.setdefault('model_embedding', 'loadtest')
+    config.update({
+        'openai_url':           llm_url,
+        'openai_key':           'loadtest',
+        'database_url':         args.database_url,
+        'context_llm':          args.context,
+        'homeserver':           homeserver_url,
+        'user_id':              BOT_USER,
+        'device_id':            'LOADTEST',
+        'access_token':         'loadtest',
+        'room_id':              ROOM_ID,
+        'matrix_encryption':    False,
+    })
+
+    # The bot uses paths relative to the working directory
+    repository = os.path.dirname(os.path.abspath(__file__))
+    directory = tempfile.mkdtemp(prefix='loadtest-')
+    os.chdir(directory)
+    os.symlink(os.path.join(repository, 'tokenizer.json'), 'tokenizer.json')
+    with open('config.yaml', 'w') as f:
+        yaml.safe_dump(config, f)
+    log = sys.stdout
+    sys.stdout = open('loadtest.log', 'w', buffering=1)
+    print(f'Load test in {directory}', file=log)
+
+    try:
+        database.Database(config).reset()
+        bot = scrittabot.ScrittaBot('config.yaml')
+        bot_errors = []
+        bot_thread = threading.Thread(target=run_bot, args=(bot, bot_errors), name='scrittabot', daemon=True)
+        bot_thread.start()
+        deadline = time.monotonic() + 60
+        while not homeserver.synced.wait(SAMPLE_INTERVAL):
+            check_bot(bot_thread, bot_errors)
+            if time.monotonic() > deadline:
+                raise Exception('the bot did not sync')
+        results = []
+        users = []
+        for n in sorted(int(u) for u in args.users.split(',')):
+            while len(users) < n:
+                users.append(f'@user{len(users) + 1}:localhost')
+                homeserver.join(users[-1])
+            results.append(run_step(bot, bot_thread, bot_errors, homeserver, list(users), args))
+            print(format_step(results[-1]), file=log)
+    finally:
+        if standin is not None:
+            standin.kill()
+
+    with open(output_pathname, 'w') as f:
+        json.dump({
+            'time':         datetime.datetime.now().isoformat(timespec='seconds'),
+            'parameters':   { k: v for k, v in vars(args).items() if k not in ( 'database_url', 'config' ) },
+            'steps':        results,
+        }, f, indent=2)
+    print(f'Results written to {output_pathname}', file=log)
+
+
+if __name__ == '__main__':
+    # Python execution workers import this module, so the test is started only here
+    main()
@@ -0,0 +1,266 @@
+import bisect
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds of histogram buckets (seconds), the last bucket is +Inf
+LATENCY_BUCKETS = ( 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300 )
+DASHBOARD_REFRESH = 2       # seconds
+
+
+class Metric():
+    # Values by label values. Labels are given as keyword arguments, all of them each time.
+    def __init__(self, kind, name, help, labels=()):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}           # tuple of label values -> value
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise Exception(f'Metric {self.name} has labels {self.labels}, got {tuple(labels)}')
+        return tuple(str(labels[l]) for l in self.labels)
+
+    def samples(self):
+        # Returns a list of (labels dictionary, value)
+        with self._lock:
+            return [ (dict(zip(self.labels, k)), self._copy(v)) for k, v in sorted(self._values.items()) ]
+
+    def _copy(self, value):
+        return value
+
+class Counter(Metric):
+    def __init__(self, name, help, labels=()):
+        super().__init__('counter', name, help, labels)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    def __init__(self, name, help, labels=()):
+        super().__init__('gauge', name, help, labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+class Histogram(Metric):
+    # Value is [ count per bucket ..., sum ]
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__('histogram', name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            v = self._values.get(key)
+            if v is None:
+                v = self._values[key] = [ 0 ] * (len(self.buckets) + 2)
+            v[i] += 1
+            v[-1] += value
+
+    def time(self, **labels):
+        # Context manager observing the time spent in the block
+        return _Timer(self, labels)
+
+    def _copy(self, value):
+        return list(value)
+
+class _Timer():
+    def __init__(self, histogram, labels):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.monotonic() - self._start, **self._labels)
+        return False
+
+
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+def _register(cls, name, *args, **kwargs):
+    # Return the metric with the name, created if it does not exist, so that modules
+    # can declare their metrics at import time
+    with _metrics_lock:
+        if name not in _metrics:
+            _metrics[name] = cls(name, *args, **kwargs)
+        elif not isinstance(_metrics[name], cls):
+            raise Exception(f'Metric {name} already registered as {_metrics[name].kind}')
+        return _metrics[name]
+
+def counter(name, help, labels=()):
+    return _register(Counter, name, help, labels)
+
+def gauge(name, help, labels=()):
+    return _register(Gauge, name, help, labels)
+
+def histogram(name, help, labels=(), buckets=LATENCY_BUCKETS):
+    return _register(Histogram, name, help, labels, buckets)
+
+
+def _format_labels(labels, extra=None):
+    items = list(labels.items()) + ([ extra ] if extra else [])
+    if not items:
+        return ''
+    escaped = ( (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in items )
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+def prometheus_text():
+    # All metrics in the Prometheus text exposition format
+    with _metrics_lock:
+        metrics = sorted(_metrics.values(), key=lambda m: m.name)
+    lines = []
+    for m in metrics:
+        lines.append(f'# HELP {m.name} {m.help}')
+        lines.append(f'# TYPE {m.name} {m.kind}')
+        for labels, value in m.samples():
+            if m.kind != 'histogram':
+                lines.append(f'{m.name}{_format_labels(labels)} {value}')
+                continue
+            cumulative = 0
+            for bound, count in zip(m.buckets + ( '+Inf', ), value[:-1]):
+                cumulative += count
+                lines.append(f'{m.name}_bucket{_format_labels(labels, ("le", bound))} {cumulative}')
+            lines.append(f'{m.name}_sum{_format_labels(labels)} {value[-1]}')
+            lines.append(f'{m.name}_count{_format_labels(labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+def snapshot():
+    # All metrics as a dictionary for the dashboard
+    with _metrics_lock:
+        metrics = list(_metrics.values())
+    return { m.name: {
+        'type':     m.kind,
+        'help':     m.help,
+        'buckets':  list(m.buckets) if m.kind == 'histogram' else None,
+        'samples':  [ { 'labels': labels, 'value': value } for labels, value in m.samples() ],
+    } for m in metrics }
+
+
+DASHBOARD_HTML = '''<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>ScrittaBot</title>
+<style>
+body { font-family: sans-serif; margin: 1em 2em; }
+h2 { font-size: 1.1em; margin: 1.2em 0 0.3em; }
+table { border-collapse: collapse; font-size: 0.9em; }
+td, th { padding: 1px 8px; text-align: left; }
+td.n { text-align: right; font-family: monospace; }
+.bar { background: #58c; height: 0.8em; display: inline-block; }
+canvas { border: 1px solid #ccc; }
+</style></head>
+<body>
+<h1>ScrittaBot</h1>
+<h2>Context size (tokens)</h2>
+<canvas id="context" width="600" height="120"></canvas>
+<div id="metrics"></div>
+<script>
+const history = [];
+function escape(s) {
+  return String(s).replace(/&/g, '&amp;').replace(/</g, '&lt;').replace(/>/g, '&gt;');
+}
+function labels(l) {
+  return escape(Object.entries(l).map(([k, v]) => k + '=' + v).join(' '));
+}
+function number(v) {
+  return Number.isInteger(v) ? v : v.toPrecision(4);
+}
+function draw() {
+  const c = document.getElementById('context').getContext('2d');
+  const w = c.canvas.width, h = c.canvas.height;
+  const max = Math.max(1, ...history);
+  c.clearRect(0, 0, w, h);
+  c.beginPath();
+  history.forEach((v, i) => c.lineTo(i * w / 300, h - v / max * (h - 15)));
+  c.stroke();
+  c.fillText(max, 2, 10);
+}
+async function update() {
+  const metrics = await (await fetch('metrics.json')).json();
+  const context = metrics['scrittabot_context_tokens'];
+  if (context && context.samples.length) {
+    history.push(context.samples[0].value);
+    if (history.length > 300) history.shift();
+    draw();
+  }
+  let html = '';
+  for (const name of Object.keys(metrics).sort()) {
+    const m = metrics[name];
+    if (!m.samples.length) continue;
+    html += '<h2>' + name + '</h2><div>' + escape(m.help) + '</div><table>';
+    for (const s of m.samples) {
+      if (m.type != 'histogram') {
+        html += '<tr><td>' + labels(s.labels) + '</td><td class="n">' + number(s.value) + '</td></tr>';
+        continue;
+      }
+      const counts = s.value.slice(0, -1), total = counts.reduce((a, b) => a + b, 0);
+      const mean = total ? s.value[s.value.length - 1] / total : 0;
+      html += '<tr><th colspan="3">' + labels(s.labels) + ' count ' + total + ' mean ' + number(mean) + '</th></tr>';
+      const max = Math.max(...counts);
+      counts.forEach((n, i) => {
+        if (!n) return;
+        html += '<tr><td>&le; ' + (i < m.buckets.length ? m.buckets[i] : '+Inf') + '</td><td class="n">' + n +
+                '</td><td><span class="bar" style="width:' + (200 * n / max) + 'px"></span></td></tr>';
+      });
+    }
+    html += '</table>';
+  }
+  document.getElementById('metrics').innerHTML = html;
+}
+update();
+setInterval(update, REFRESH);
+</script>
+</body></html>
+'''.replace('REFRESH', str(DASHBOARD_REFRESH * 1000))
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/metrics':
+            body, content_type = prometheus_text(), 'text/plain; version=0.0.4; charset=utf-8'
+        elif path == '/metrics.json':
+            body, content_type = json.dumps(snapshot()), 'application/json'
+        elif path == '/':
+            body, content_type = DASHBOARD_HTML, 'text/html; charset=utf-8'
+        else:
+            self.send_error(404)
+            return
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def serve(port, host='127.0.0.1'):
+    # Serve /metrics (Prometheus), /metrics.json and the dashboard at / in a background thread
+    server = ThreadingHTTPServer((host, port), _Handler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
+
+
+# Tests
+if __name__ == '__main__':
+    requests = counter('test_requests_total', 'Requests', ( 'pool', ))
+    latency = histogram('test_latency_seconds', 'Latency', ( 'pool', ))
+    requests.inc(pool='chat')
+    requests.inc(2, pool='embedding')
+    latency.observe(0.003, pool='chat')
+    with latency.time(pool='chat'):
+        time.sleep(0.02)
+    gauge('test_tokens', 'Tokens').set(1234)
+    print(prometheus_text())
@@ -0,0 +1,46 @@
+import hashlib
+import random
+import struct
+
+import keywords
+
+MINHASH_PERMUTATIONS = 64
+MINHASH_BANDS = 16          # Bands for LSH lookup, each MINHASH_PERMUTATIONS/MINHASH_BANDS rows
+SHINGLE_WORDS = 3           # Number of words in a shingle
+NEARDUP_THRESHOLD = 0.9     # Minimum estimated Jaccard similarity of near-duplicates
+
+_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+_rng = random.Random(0x5c7177a)     # Fixed seed: signatures are stored in the database
+_PERMUTATIONS = [ (_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(MINHASH_PERMUTATIONS) ]
+
+
+def _hash(data: bytes, bits=32):
+    return int.from_bytes(hashlib.blake2b(data, digest_size=bits // 8).digest(), 'little')
+
+def shingles(text: str):
+    # Return hashes of overlapping word n-grams of the text
+    w = keywords.words(text)
+    n = min(SHINGLE_WORDS, len(w))
+    return { _hash(' '.join(w[i:i+n]).encode('utf-8')) for i in range(len(w) - n + 1) } if w else set()
+
+def signature(text: str):
+    # MinHash signature: for each permutation, the minimum permuted shingle hash
+    sh = shingles(text)
+    if not sh:
+        return None
+    return [ min(((a * x + b) % _PRIME) & _MAX_HASH for x in sh) for a, b in _PERMUTATIONS ]
+
+def bands(sig):
+    # Hash each band of the signature together with the band number. Documents with
+    # Jaccard similarity s share at least one band with probability 1-(1-s^rows)^bands.
+    rows = len(sig) // MINHASH_BANDS
+    r = []
+    for b in range(MINHASH_BANDS):
+        h = _hash(struct.pack(f'<I{rows}I', b, *sig[b*rows:(b+1)*rows]), bits=64)
+        r.append(h - (1 << 64) if h >= (1 << 63) else h)       # Signed for BIGINT
+    return r
+
+def similarity(sig1, sig2):
+    # Estimated Jaccard similarity of the shingle sets
+    return sum(1 for a, b in zip(sig1, sig2) if a == b) / len(sig1)
@@ -1,11 +1,101 @@
-from smolagents.local_python_executor import (
-    BASE_PYTHON_TOOLS,
-    evaluate_python_code,
-)
+import multiprocessing
+import os
+import pickle
+import time
+
+import metrics
+
+EXECUTION_TIMEOUT = 60              # seconds, wall-clock time of one execution without tool calls
+EXECUTION_MAX_MEMORY = 1 << 30      # bytes, resident memory of the worker process
+OUTPUT_MAX_SIZE = 100000            # characters of output from one execution
+STATE_MAX_SIZE = 4 << 20            # bytes, pickled variables kept between executions
+SPARE_WORKERS = 1                   # Workers started in advance
+POLL_INTERVAL = 0.1                 # seconds, how often worker memory is checked
+
+EXECUTIONS = metrics.counter('scrittabot_code_executions_total', 'Executions of code blocks by result', ( 'result', ))
+EXECUTION_SECONDS = metrics.histogram('scrittabot_code_execution_seconds', 'Duration of code block executions')
+TOOL_CALLS = metrics.counter('scrittabot_tool_calls_total', 'Tool calls from executed code by tool and status', ( 'tool', 'status' ))
+TOOL_SECONDS = metrics.histogram('scrittabot_tool_seconds', 'Duration of tool calls by tool', ( 'tool', ))
+
+
+def _snapshot(state, max_size):
+    # Pickle variables of the state. Variables which can not be pickled are not
+    # included, and the largest variables are discarded if the total is too large.
+    pickled = {}
+    for k, v in state.items():
+        if k.startswith('_'):
+            continue
+        try:
+            pickled[k] = pickle.dumps(v)
+        except Exception:
+            pass
+    discarded = []
+    size = sum(len(p) for p in pickled.values())
+    for k in sorted(pickled, key=lambda k: -len(pickled[k])):
+        if size <= max_size:
+            break
+        size -= len(pickled.pop(k))
+        del state[k]
+        discarded.append(k)
+    return pickle.dumps(pickled), discarded
+
+def _worker(conn, tool_names, max_output, max_state):
+    # Executes code in a subprocess. Calls of the tools are sent to the parent process.
+    from smolagents.local_python_executor import (
+        BASE_PYTHON_TOOLS,
+        PrintContainer,
+        evaluate_python_code,
+    )
+    state = {}
+
+    def proxy(name):
+        def call(*args, **kwargs):
+            conn.send(('call', name, args, kwargs))
+            status, result, printed = conn.recv()
+            state['_print_outputs'] += printed
+            if status == 'error':
+                raise Exception(result)
+            return result
+        return call
+
+    tooldict = dict(BASE_PYTHON_TOOLS)
+    tooldict.update({ name: proxy(name) for name in tool_names })
+    while True:
+        msg = conn.recv()
+        if msg[0] == 'restore':
+            state.update({ k: pickle.loads(v) for k, v in pickle.loads(msg[1]).items() })
+        elif msg[0] == 'execute':
+            state['_print_outputs'] = PrintContainer()
+            try:
+                evaluate_python_code(msg[1], tooldict, state=state)
+            except Exception as e:
+                print(f'EXCEPTION: {e}')
+                state['_print_outputs'] += str(e)
+            output = str(state['_print_outputs'])
+            if len(output) > max_output:
+                output = output[:max_output] + f'\n[Output truncated to {max_output} characters]'
+            snapshot, discarded = _snapshot(state, max_state)
+            if discarded:
+                output += f'\n[Variables discarded because of size: {", ".join(discarded)}]'
+            conn.send(('done', output, snapshot))
+
+def _rss(pid):
+    # Resident memory of the process in bytes, None if not available (only Linux has /proc)
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
 
 class PythonExecution():
-    def __init__(self, tool_list):
-        self._state = {}
+    # Executes code in a subprocess with time and memory limits. Workers are started in
+    # advance, so a worker killed because of the limits is replaced without delay. The
+    # variables are kept between executions and restored to a new worker.
+    def __init__(self, tool_list, config={}, docs=None):
+        # docs(name) returns documentation of a tool, added to the output when a call fails
+        self._printed = ''
+        self._docs = docs
         tooldict = {}
         for tool in tool_list:
             tool.set_print(self._custom_print)
@@ -17,16 +107,99 @@ class PythonExecution():
                 if name in tooldict:
                     raise Exception('Tool already defined')
                 tooldict[name] = t[1]
-        self._tooldict = BASE_PYTHON_TOOLS
-        self._tooldict.update(tooldict)
+        self._tooldict = tooldict
+        self._timeout = config.get('python_timeout', EXECUTION_TIMEOUT)
+        self._max_memory = config.get('python_max_memory', EXECUTION_MAX_MEMORY)
+        if _rss(os.getpid()) is None:
+            print('PythonExecution: memory of processes is not available, python_max_memory is not enforced')
+        self._max_output = config.get('python_max_output', OUTPUT_MAX_SIZE)
+        self._max_state = config.get('python_max_state', STATE_MAX_SIZE)
+        self._context = multiprocessing.get_context('spawn')
+        self._worker = None             # (process, connection)
+        self._spares = []
+        self._snapshot = None           # Pickled variables from the latest execution
+        self._start_spares()
 
     def _custom_print(self, s):
-        self._state["_print_outputs"].value += s
+        self._printed += s
 
-    def execute(self, code):
+    def _start_spares(self):
+        while len(self._spares) < SPARE_WORKERS:
+            conn, child_conn = self._context.Pipe()
+            process = self._context.Process(
+                target = _worker,
+                args = (child_conn, list(self._tooldict.keys()), self._max_output, self._max_state),
+                daemon = True,
+            )
+            process.start()
+            child_conn.close()
+            self._spares.append((process, conn))
+
+    def _kill(self):
+        process, conn = self._worker
+        self._worker = None
+        process.kill()
+        process.join()
+        conn.close()
+
+    def _call(self, name, args, kwargs):
+        # Run a tool for the worker, returning (status, result, printed output)
+        self._printed = ''
         try:
-            result, _ = evaluate_python_code(code, self._tooldict, state=self._state)
+            with TOOL_SECONDS.time(tool=name):
+                result = self._tooldict[name](*args, **kwargs)
+            pickle.dumps(result)
+            TOOL_CALLS.inc(tool=name, status='ok')
+            return ('ok', result, self._printed)
         except Exception as e:
-            print(f'EXCEPTION: {e}')
-            self._custom_print(str(e))
-        return self._state["_print_outputs"].value
+            TOOL_CALLS.inc(tool=name, status='error')
+            if self._docs is not None:
+                self._printed += f'Call of {name} failed, its documentation is:\n{self._docs(name)}\n'
+            return ('error', f'{type(e).__name__}: {e}', self._printed)
+
+    def execute(self, code):
+        start = time.monotonic()
+        result, output = self._execute(code)
+        EXECUTIONS.inc(result=result)
+        EXECUTION_SECONDS.observe(time.monotonic() - start)
+        return output
+
+    def _execute(self, code):
+        # Returns (result, output) where result is 'ok', 'crashed', 'memory', or 'timeout'
+        if self._worker is None or not self._worker[0].is_alive():
+            if self._worker is not None:
+                self._kill()
+            self._start_spares()
+            self._worker = self._spares.pop(0)
+            if self._snapshot is not None:
+                self._worker[1].send(('restore', self._snapshot))
+            self._start_spares()
+        process, conn = self._worker
+
+        conn.send(('execute', code))
+        deadline = time.monotonic() + self._timeout
+        while True:
+            try:
+                ready = conn.poll(POLL_INTERVAL)
+                if ready:
+                    msg = conn.recv()
+            except (EOFError, OSError):
+                self._kill()
+                return 'crashed', 'Execution failed: Python process terminated'
+            if not ready:
+                rss = _rss(process.pid)
+                if rss is not None and rss > self._max_memory:
+                    self._kill()
+                    return 'memory', f'Execution aborted: memory limit of {self._max_memory} bytes exceeded'
+                if time.monotonic() > deadline:
+                    self._kill()
+                    return 'timeout', f'Execution aborted: time limit of {self._timeout} seconds exceeded'
+                continue
+            if msg[0] == 'call':
+                # Time spent in tools of the parent process is not counted
+                call_start = time.monotonic()
+                conn.send(self._call(*msg[1:]))
+                deadline += time.monotonic() - call_start
+            elif msg[0] == 'done':
+                self._snapshot = msg[2]
+                return 'ok', msg[1]
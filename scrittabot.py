@@ -3,6 +3,15 @@
 CONFIG_FILE = 'config.yaml'
 EMBEDDING_QUERY = ''
 IMAGE_MAX_SIZE = 256
+EVENTS_PER_TURN = 10        # Maximum number of received messages handled in one turn
+PREEMPT = True              # Interrupt generation when a high priority event arrives
+EXECUTE_AND_CONTINUE = False    # Stop generation after code with output and continue with the output
+MAX_CONTINUATIONS = 5       # Maximum number of continuations in one turn
+LLAMA_SLOTS = False         # Pin the dialogue to a llama-server slot and indexing to other slots
+AGENT_SLOT = 0              # llama-server slot of the dialogue
+SLOT_SAVE_FILE = 'scrittabot-agent.bin'     # KV cache of the dialogue slot saved at shutdown
+METRICS_PORT = None         # Port of the metrics endpoint and dashboard, None to disable
+METRICS_HOST = '127.0.0.1'
 
 OPTIONS = {
     'max_tokens': 4096,
@@ -12,40 +21,78 @@ OPTIONS = {
     'cache_prompt': True,
 }
 
+import collections
+import statistics
 import time
 import pprint
 import yaml
 
 import context
+import events
 import librarian
 import llm
+import metrics
 import python_execution
 import tools
 import tool_matrix
+import tool_output
+
+TURNS = metrics.counter('scrittabot_turns_total', 'Turns of the agent')
+COMPLETIONS = metrics.counter('scrittabot_completions_total', 'Completions of the agent by result', ( 'result', ))
+REDUCTIONS = metrics.counter('scrittabot_context_reductions_total', 'Reductions of the context')
+CONTEXT_TOKENS = metrics.gauge('scrittabot_context_tokens', 'Prompt tokens of the latest completion of the agent')
+MESSAGE_LATENCY_SECONDS = metrics.histogram('scrittabot_message_latency_seconds',
+    'Time from receiving a message to the first token of the response')
 
 class ScrittaBot():
-    def __init__(self):
-        with open(CONFIG_FILE, 'r') as f:
+    def __init__(self, config_file=CONFIG_FILE):
+        with open(config_file, 'r') as f:
             self._config = yaml.safe_load(f)
+        metrics_port = self._config.get('metrics_port', METRICS_PORT)
+        if metrics_port:
+            metrics_host = self._config.get('metrics_host', METRICS_HOST)
+            metrics.serve(metrics_port, metrics_host)
+            print(f'Metrics and dashboard at http://{metrics_host}:{metrics_port}/')
 
         options = OPTIONS
         options['model'] = self._config['model_llm']
-        self._llm = llm.LlmLineStreaming(self._config['openai_url'], self._config['openai_key'], options, insecure=True)
+        self._llama_slots = self._config.get('llama_slots', LLAMA_SLOTS)
+        self._llm = llm.LlmLineStreaming(self._config['openai_url'], self._config['openai_key'], options, insecure=True,
+            pool='chat', priority=llm.PRIORITY_INTERACTIVE, slot=self._config.get('agent_slot', AGENT_SLOT) if self._llama_slots else None,
+            **llm.config_options(self._config))
+        if self._llama_slots:
+            # Continue from the prompt cache of the previous run
+            try:
+                result = self._llm.slot_action('restore', self._config.get('slot_save_file', SLOT_SAVE_FILE))
+                print(f'SLOT restored {result.get("n_restored")} tokens')
+            except Exception as e:
+                print(f'SLOT restore failed ({e})')
 
         self._librarian = librarian.Librarian(config=self._config)
+        self._bus = events.EventBus()
 
         self._tools_basic = tools.ToolSetBasic()
         self._tools_system = tools.ToolSetSystem()
-        self._tools_matrix = tool_matrix.ToolSetMatrix(self._config, self._librarian)
+        self._tools_matrix = tool_matrix.ToolSetMatrix(self._config, self._librarian, self._bus)
+        self._tools_output = tool_output.ToolSetOutput(self._config, self._librarian)
         self._tool_list = [
             self._tools_basic,
             self._tools_system,
             self._tools_matrix,
+            self._tools_output,
         ]
-        self._python_execution = python_execution.PythonExecution(self._tool_list)
+        self._tools_help = tools.ToolSetHelp(self._tool_list)
+        self._tool_list.append(self._tools_help)
+        # With only an index of the tools in the context, attach the documentation to failed calls
+        tools_section = self._config.get('tools_section', context.TOOLS_SECTION)
+        self._python_execution = python_execution.PythonExecution(self._tool_list, self._config,
+            docs = self._tools_help.doc if tools_section == 'index' else None)
 
         self._section_instructions = context.SectionInstructions()
-        self._section_tools = context.SectionTools(self._tool_list)
+        self._section_tools = context.SectionTools(self._tool_list, tools_section)
+        print('TOOLS section tokens ' + ' '.join(
+            f'{mode}:{self._librarian.tokenizer.tokenize(self._section_tools.text(mode)).count()}'
+            for mode in ( 'full', 'index' )) + f' using:{tools_section}')
         self._section_mood = context.SectionMood()
         self._section_goals = context.SectionGoals()
         self._section_dialogue = context.SectionDialogue()
@@ -58,35 +105,127 @@ class ScrittaBot():
             self._section_dialogue,
         ])
         self._context_size = [ 0 ] * 5
+        self._message_time = None       # Reception time of the oldest message not yet responded to
+        self._latency = collections.deque(maxlen=100)   # Message-to-first-token latencies
+        self._generating = False
+        self._preempt = self._config.get('preempt', PREEMPT)
+        self._execute_and_continue = self._config.get('execute_and_continue', EXECUTE_AND_CONTINUE)
+        self._bus.add_listener(self._on_event)
+        self.stats = {
+            'turns':            0,      # Turns of the agent (_run_llm() calls)
+            'completions':      0,      # Completions including continuations
+            'reductions':       0,      # Successful reductions of the context
+            'context_size':     0,      # Prompt tokens of the latest completion
+            'context_tokens':   0,      # Prompt tokens of all completions
+        }
+
+    def _on_event(self, source, priority):
+        # Called in the thread of the event source
+        if self._preempt and self._generating and priority >= events.PRIORITY_HIGH:
+            print(f'PREEMPT by {source} event')
+            self._llm.cancel()
 
     def _run_llm(self):
+        # Returns outputs of the executed code which are not yet in the dialogue
+        cached_tokens = 0           # Prompt tokens reused from cache by continuations
+        unused_tokens = 0           # Tokens generated after code output without seeing it
+        self.stats['turns'] += 1
+        TURNS.inc()
+        for continuation in range(MAX_CONTINUATIONS + 1):
+            output, stopped, after_output = self._run_completion()
+            if continuation > 0:
+                cached_tokens += self._llm.completion_stats()['timings'].get('cache_n', 0)
+            if after_output:
+                unused_tokens += self._librarian.tokenizer.tokenize(after_output).count()
+            self._check_context()
+            if not stopped:
+                break
+            # Continue the turn with the code output in the dialogue
+            for o in output:
+                self._section_dialogue.add_chunk(service='python', content=o)
+            output = []
+        if continuation > 0:
+            print(f'RUN LLM continuations:{continuation} cached_tokens:{cached_tokens}')
+        if unused_tokens:
+            print(f'RUN LLM tokens_after_code_output:{unused_tokens}')
+        return output
+
+    def _run_completion(self):
+        # Run one completion and execute the code in it. Returns (outputs, stopped, text)
+        # where stopped is True if the completion was stopped after code with output
+        # (execute_and_continue mode) and text is generated after the first code output.
         msgs = self._context_manager.messages()
         #pprint.pp(msgs)
         print(f'RUN LLM dialogue:{len(msgs)}')
+        self.stats['completions'] += 1
         comp = self._llm.completion(msgs)
+        started = time.monotonic()          # The request is sent when the first line is requested
         in_python = False
         completion = ''
+        after_output = None
         output = []
+        stopped = False
+        self._generating = True
         for line in comp:
+            if self._message_time is not None:
+                # Latency until the first token of the response
+                ttft = self._llm.completion_stats()['client'].get('ttft')
+                first_token = started + ttft if ttft is not None else time.monotonic()
+                self._latency.append(first_token - self._message_time)
+                MESSAGE_LATENCY_SECONDS.observe(self._latency[-1])
+                self._message_time = None
+                print(f'LATENCY message-to-first-token:{self._latency[-1]:.3f}s median:{statistics.median(self._latency):.3f}s')
             print(line)
             completion += line + '\n'
+            if after_output is not None:
+                after_output += line + '\n'
             line_strip = line.strip()
             if line_strip == '```' and in_python:
                 in_python = False
-                out = self._python_execution.execute(python)
+                # Large outputs are stored in the library, only a preview goes to the dialogue
+                out = self._tools_output.spool(self._python_execution.execute(python))
                 if out:
                     output.append(out)
+                    if self._execute_and_continue:
+                        stopped = True
+                        break
+                    if after_output is None:
+                        after_output = ''
             if in_python:
                 python += line + '\n'
             if line_strip == '```python':
                 in_python = True
                 python = ''
+        comp.close()                # Stops generation if the loop was exited early
+        self._generating = False
+        client = self._llm.completion_stats()['client']
+        if client.get('ttft') is not None:
+            print(f'RUN LLM ttft:{client["ttft"]:.3f}s tokens:{client["tokens"]} '
+                  f'tokens/s:{client["tokens_per_second"] or 0:.1f} itl_p90:{client["itl_p90"] or 0:.3f}s '
+                  f'total:{client["total_time"]:.3f}s')
 
-        self._section_dialogue.add_chunk(content=completion)
+        COMPLETIONS.inc(result='cancelled' if self._llm.cancelled() else 'stopped' if stopped else 'complete')
+        if self._llm.cancelled():
+            # Keep the truncated response, the new event is handled in the next turn
+            print(f'RUN LLM interrupted after {len(completion)} characters')
+            if completion:
+                self._section_dialogue.add_chunk(content=completion)
+            note = 'Your response was interrupted by a new event.'
+            if in_python:
+                note += ' The unfinished code block was not executed.'
+            self._section_dialogue.add_chunk(service='system', content=note)
+        else:
+            self._section_dialogue.add_chunk(content=completion)
+        return output, stopped, after_output
 
+    def _check_context(self):
         # Check if we're running out of context, and if so, reduce used context
-        context_size = self._llm.completion_stats()['usage']['prompt_tokens']
+        # (no usage statistics if the completion was interrupted or stopped)
+        context_size = self._llm.completion_stats()['usage'].get('prompt_tokens', self._context_size[-1])
         print(f'RUN LLM context_size:{context_size}')
+        self.stats['context_size'] = context_size
+        CONTEXT_TOKENS.set(context_size)
+        self.stats['context_tokens'] += context_size
         self._context_size = self._context_size[1:] + [context_size]
         estimated_increase = 2*max([s[0]-s[1] for s in zip(self._context_size[1:], self._context_size[:-1])])
         print(f'estimated_increase {estimated_increase}')
@@ -95,9 +234,17 @@ class ScrittaBot():
             if not self._context_manager.reduce():
                 print('WARNING: Possible context overflow, can not reduce enough')
                 break
+            self.stats['reductions'] += 1
+            REDUCTIONS.inc()
             estimated_context = self._llm.count_tokens(self._context_manager.messages()) + estimated_increase
 
-        return output
+    def close(self):
+        if self._llama_slots:
+            try:
+                result = self._llm.slot_action('save', self._config.get('slot_save_file', SLOT_SAVE_FILE))
+                print(f'SLOT saved {result.get("n_saved")} tokens')
+            except Exception as e:
+                print(f'SLOT save failed ({e})')
 
     def run(self):
         while True:
@@ -107,8 +254,8 @@ class ScrittaBot():
             sleep = self._tools_system.get_sleep()
             wake = None
             if sleep is not None and sleep >= 0:
-                wake = int(time.time()) + 60*sleep + 1
-            while wake is None or int(time.time()) < wake:
+                wake = time.monotonic() + 60*sleep
+            while True:
                 events = 0
 
                 # Check events, break if any
@@ -117,25 +264,45 @@ class ScrittaBot():
                     self._section_dialogue.add_chunk(service='python', content=o)
                 output = []
 
-                matrix_events = self._tools_matrix.get_events()
+                dropped = self._tools_matrix.take_dropped()
+                if dropped:
+                    events += 1
+                    senders = ', '.join(f'{n} from {s}' for s, n in dropped.items())
+                    self._section_dialogue.add_chunk(service='system', content=f'Too many messages, some were not delivered ({senders})')
+
+                matrix_events = self._tools_matrix.get_events(self._config.get('events_per_turn', EVENTS_PER_TURN))
                 events += len(matrix_events)
                 for m in matrix_events:
+                    if self._message_time is None:
+                        self._message_time = m['received']
                     extra = f'user="{m["sender"]}"'
+                    if m['error']:
+                        extra += f' error="{m["error"]}"'
                     if not m['file']:
                         # It is a regular message
                         self._section_dialogue.add_chunk(service='message', extra=extra, content=m['body'])
                     else:
                         f = m['file']
                         extra += f' filename="{f.filename()}"'
-                        self._section_dialogue.add_chunk(media_type=f.type(), service='message', extra=extra, content=f.content())
+                        self._section_dialogue.add_chunk(media_type='image' if f.type() == 'image' else 'text', service='message', extra=extra, content=f.content())
 
                 if events > 0:
                     break
                 if sleep is not None and sleep <= 0:
                     break
-                time.sleep(1)
+                # Sleep until an event source signals or the wake-up time is reached
+                timeout = None if wake is None else wake - time.monotonic()
+                if timeout is not None and timeout <= 0:
+                    break
+                self._bus.wait(timeout)
 
-scrittabot = ScrittaBot()
-scrittabot.run()
+if __name__ == '__main__':
+    # Python execution workers import this module, so the bot is started only here
+    import sys
+    scrittabot = ScrittaBot(sys.argv[1] if len(sys.argv) > 1 else CONFIG_FILE)
+    try:
+        scrittabot.run()
+    finally:
+        scrittabot.close()
 
 # EOF
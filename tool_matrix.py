@@ -1,30 +1,130 @@
+import aiohttp
 import asyncio
+import concurrent.futures
+import hashlib
 import markdown
 import nio
+import os
+import threading
+import time
+import unpaddedbase64
+import urllib.parse
+from Crypto.Cipher import AES
+from Crypto.Util import Counter
 
+import events
+import metrics
 import tools
 
 TIMEOUT = 30000         # milliseconds
+SYNC_RETRY = 5          # seconds
+SEND_COALESCE = 0.3     # seconds, messages queued within this time are sent as one
+SEND_RETRIES = 5
+SEND_BACKOFF = 1.0      # seconds, doubled on each retry
+ROOM_ID_TTL = 3600      # seconds
+DOWNLOAD_CONCURRENCY = 3
+DOWNLOAD_MAX_SIZE = 100 * 1024**2       # bytes, per file
+DOWNLOAD_MAX_TOTAL = 500 * 1024**2      # bytes, all downloads in progress
+DOWNLOAD_READ_TIMEOUT = 60             # seconds without receiving data, no limit for the whole download
+DECRYPT_BLOCK_SIZE = 1 << 20
+ENCRYPTION = True       # End-to-end encryption (needs libolm)
+
+SYNCS = metrics.counter('scrittabot_matrix_syncs_total', 'Sync responses from the Matrix server')
+EVENTS = metrics.counter('scrittabot_matrix_events_total', 'Received Matrix messages by priority', ( 'priority', ))
+EVENT_DELAY_SECONDS = metrics.histogram('scrittabot_matrix_event_delay_seconds',
+    'Time from sending a message (server timestamp) to receiving it')
+INBOUND_DEPTH = metrics.gauge('scrittabot_matrix_inbound_depth', 'Received messages waiting to be handled')
+SEND_SECONDS = metrics.histogram('scrittabot_matrix_send_seconds', 'Duration of sending messages including retries')
+SEND_FAILURES = metrics.counter('scrittabot_matrix_send_failures_total', 'Messages which could not be sent')
+
+# Only the events that we handle, members loaded lazily
+SYNC_FILTER = {
+    'presence': { 'types': [] },
+    'account_data': { 'types': [] },
+    'room': {
+        'timeline': { 'types': [ 'm.room.message', 'm.room.encrypted', 'm.room.member' ] },
+        'state': { 'lazy_load_members': True },
+        'ephemeral': { 'types': [] },
+        'account_data': { 'types': [] },
+    },
+}
+
+def decrypt_file(pathname, key, sha256, iv):
+    # Verify and decrypt an encrypted attachment in place, one block at a time
+    h = hashlib.sha256()
+    with open(pathname, 'rb') as f:
+        while block := f.read(DECRYPT_BLOCK_SIZE):
+            h.update(block)
+    if h.digest() != unpaddedbase64.decode_base64(sha256):
+        raise Exception('mismatched SHA-256 digest')
+    byte_iv = unpaddedbase64.decode_base64(iv)
+    ctr = Counter.new(64, prefix=byte_iv[:8], initial_value=int.from_bytes(byte_iv[8:], 'big'))
+    cipher = AES.new(unpaddedbase64.decode_base64(key), AES.MODE_CTR, counter=ctr)
+    with open(pathname, 'r+b') as f:
+        while block := f.read(DECRYPT_BLOCK_SIZE):
+            f.seek(-len(block), os.SEEK_CUR)
+            f.write(cipher.decrypt(block))
+
+def reserved_size(content, max_size):
+    # Bytes reserved for downloading the file of a message. The size declared by the sender
+    # is not trusted, it is enforced while downloading, and without it max_size is reserved.
+    size = (content.get('info') or {}).get('size')
+    return size if isinstance(size, int) and size > 0 else max_size
+
+async def fetch(client, mxc, pathname, limit):
+    # Download the file of mxc URI with nio.AsyncClient to pathname, failing if the response
+    # is not 200 OK or the file is larger than limit bytes
+    url = urllib.parse.urlparse(mxc)
+    method, path = nio.Api.download(url.netloc, url.path.strip('/'))
+    path = path.split('?')[0]           # Defaults, the access token goes in the header
+    headers = { 'Authorization': f'Bearer {client.access_token}' }
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=DOWNLOAD_READ_TIMEOUT)
+    response = await client.send(method, path, headers=headers, timeout=timeout)
+    try:
+        if response.status != 200:
+            raise Exception(f'download failed (HTTP status {response.status})')
+        if (response.content_length or 0) > limit:
+            raise Exception(f'file too large ({response.content_length} bytes)')
+        size = 0
+        with open(pathname, 'wb') as f:
+            async for block in response.content.iter_chunked(DECRYPT_BLOCK_SIZE):
+                size += len(block)
+                if size > limit:
+                    raise Exception(f'file too large (over {limit} bytes)')
+                f.write(block)
+    finally:
+        response.release()
+
 
 class ToolSetMatrix(tools.ToolSetBasic):
-    def __init__(self, config, librarian):
+    def __init__(self, config, librarian, bus=None):
         super().__init__()
 
         self._config = config
         self._librarian = librarian
+        self._bus = bus                     # events.EventBus signalled when events are received
         self._client = None         # nio client
         self._insecure = True       # Do not verify SSL
         self._default_room = self._config['room_id']
         self._timeout = TIMEOUT
-        self._events = []
-        self._event_loop = asyncio.get_event_loop()
+        self._events = events.InboundQueue(self._config.get('inbound_queue_size', events.INBOUND_MAX))
+        self._synced = threading.Event()    # Set after the first sync
+        self._event_loop = asyncio.new_event_loop()
+        self._outbox = asyncio.Queue()      # Messages to be sent
+        self._room_ids = {}                 # Resolved room ids, room info -> (room_id, expiry time)
+        self._download_max_size = self._config.get('download_max_size', DOWNLOAD_MAX_SIZE)
+        self._download_max_total = self._config.get('download_max_total', DOWNLOAD_MAX_TOTAL)
+        self._download_slots = asyncio.Semaphore(self._config.get('download_concurrency', DOWNLOAD_CONCURRENCY))
+        self._download_space = asyncio.Condition()
+        self._downloading = 0               # Total size of downloads in progress
+        self._ingestion = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='ingestion')
 
         # Configuration options for the nio.AsyncClient
         client_config = nio.AsyncClientConfig(
             max_limit_exceeded = 0,
             max_timeouts = 0,
             store_sync_tokens = True,
-            encryption_enabled = True,
+            encryption_enabled = self._config.get('matrix_encryption', ENCRYPTION),
         )
         # Initialize the matrix client based on configuration
         self._client = nio.AsyncClient(
@@ -59,12 +159,20 @@ class ToolSetMatrix(tools.ToolSetBasic):
              nio.events.invite_events.InviteMemberEvent,
              nio.events.invite_events.InviteNameEvent))
 
+        self._client.add_response_callback(self._sync_callback, nio.SyncResponse)
+
         self._client.restore_login(
             user_id = self._config['user_id'],
             device_id = self._config['device_id'],
             access_token = self._config['access_token'],
         )
 
+        # All communication with the server runs in the event loop of a separate thread
+        self._thread = threading.Thread(target=self._event_loop.run_forever, name='matrix', daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._sync_forever(), self._event_loop)
+        asyncio.run_coroutine_threadsafe(self._sender(), self._event_loop)
+
     def tools(self):
         return [
 ('''send_message(message: str):
@@ -77,63 +185,194 @@ class ToolSetMatrix(tools.ToolSetBasic):
         ]
 
     def _send_message(self, message: str):
+        # Queue the message to be sent by the Matrix thread and return immediately
+        self._event_loop.call_soon_threadsafe(self._outbox.put_nowait, message)
+        self._print('Message sent')
+
+    async def _sender(self):
+        # Send queued messages, combining messages queued within SEND_COALESCE seconds
+        while True:
+            messages = [ await self._outbox.get() ]
+            deadline = self._event_loop.time() + SEND_COALESCE
+            while (remaining := deadline - self._event_loop.time()) > 0:
+                try:
+                    messages.append(await asyncio.wait_for(self._outbox.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                with SEND_SECONDS.time():
+                    await self._send('\n\n'.join(messages))
+            except Exception as e:
+                SEND_FAILURES.inc()
+                print(f'Matrix: failed to send message ({self._privacy_filter(str(e))})')
+
+    async def _send(self, message: str):
         # "Logged in as @alice:example.org device id: RANDOMDID"
         # If you made a new room and haven't joined as that user, you can use
         # await self._client.join("your-room-id")
 
-        self._sync()
-        room_id = self._event_loop.run_until_complete(self._map_roominfo_to_roomid(self._default_room))
-
-        html = markdown.markdown(message, extensions=['tables', 'extra', 'sane_lists'])
-        resp = self._event_loop.run_until_complete(self._client.room_send(
-            # Watch out! If you join an old room you'll see lots of old messages
-            room_id = room_id,
-            message_type = 'm.room.message',
-            content = {
-                'msgtype': 'm.text',
-                'format': 'org.matrix.custom.html',
-                'formatted_body': html,
-                'body': html,
-            },
-            ignore_unverified_devices = True,
-        ))
-        self._print('Message sent')
+        while not self._synced.is_set():
+            await asyncio.sleep(SEND_BACKOFF)
+        room_id = await self._room_id(self._default_room)
 
-    def get_events(self):
-        self._sync()
-        events = self._events
-        self._events = []
-
-        r = []
-        for room, event in events:
-            if event.sender == self._config['user_id']:
-                continue        # Skip events from self
-            if event.source['type'] != 'm.room.message':
-                continue
-            if hasattr(event, 'url'):
-                # Download file
-                response = self._event_loop.run_until_complete(self._client.download(mxc=event.url))
-                print(f'Matrix: downloaded file, {response}')
-                f = self._librarian.add_file(event.body, response.body)
-                print(f'Downloaded "{f.filename()} type {f.type()}"')
-            else:
-                f = None
-            r.append({
-                'type': event.source['type'],
-                'sender': event.source['sender'],
-                'room': room.display_name,
-                'msgtype': event.source['content']['msgtype'],
-                'body': event.source['content']['body'],
-                'origin_server_ts': event.source['origin_server_ts'],
-                'file': f,
-            })
-        return r
+        html = await self._event_loop.run_in_executor(None,
+            lambda: markdown.markdown(message, extensions=['tables', 'extra', 'sane_lists']))
+        for retry in range(SEND_RETRIES):
+            try:
+                resp = await self._client.room_send(
+                    # Watch out! If you join an old room you'll see lots of old messages
+                    room_id = room_id,
+                    message_type = 'm.room.message',
+                    content = {
+                        'msgtype': 'm.text',
+                        'format': 'org.matrix.custom.html',
+                        'formatted_body': html,
+                        'body': html,
+                    },
+                    ignore_unverified_devices = True,
+                )
+            except Exception as e:
+                resp = e
+            if isinstance(resp, nio.RoomSendResponse):
+                return
+            # Respect server rate limits, otherwise back off exponentially
+            delay = SEND_BACKOFF * 2**retry
+            if getattr(resp, 'retry_after_ms', None):
+                delay = resp.retry_after_ms / 1000
+            print(f'Matrix: sending failed ({self._privacy_filter(str(resp))}), retrying in {delay:.1f}s')
+            await asyncio.sleep(delay)
+        raise Exception(f'giving up after {SEND_RETRIES} attempts')
+
+    async def _room_id(self, info: str) -> str:
+        # Resolve room id, caching the result for ROOM_ID_TTL seconds
+        cached = self._room_ids.get(info)
+        if cached and cached[1] > self._event_loop.time():
+            return cached[0]
+        room_id = await self._map_roominfo_to_roomid(info)
+        if room_id.startswith('!'):
+            self._room_ids[info] = (room_id, self._event_loop.time() + ROOM_ID_TTL)
+        return room_id
+
+    def get_events(self, max_events=None):
+        # Return at most max_events received events without blocking, direct mentions first
+        received = self._events.get(max_events)
+        INBOUND_DEPTH.set(self._events.stats()['depth'])
+        return received
+
+    def take_dropped(self):
+        # Return numbers of events dropped because of overflow by sender
+        return self._events.take_dropped()
+
+    def inbound_stats(self):
+        return self._events.stats()
 
     async def _event_callback(self, room: nio.MatrixRoom, event: nio.RoomMessage) -> None:
-        self._events.append((room, event))
+        received = time.monotonic()
+        if event.sender == self._config['user_id']:
+            return          # Skip events from self
+        if event.source['type'] != 'm.room.message':
+            return
+        if hasattr(event, 'url'):
+            # Deliver the event after the file has been downloaded and stored
+            self._event_loop.create_task(self._download(room, event, received))
+        else:
+            self._deliver(room, event, received)
+
+    def _deliver(self, room, event, received, f=None, error=None, source='matrix'):
+        priority = events.PRIORITY_HIGH if self._is_mention(room, event) else events.PRIORITY_LOW
+        EVENTS.inc(priority=priority)
+        EVENT_DELAY_SECONDS.observe(max(0.0, time.time() - event.source['origin_server_ts'] / 1000))
+        self._events.put({
+            'type': event.source['type'],
+            'sender': event.source['sender'],
+            'room': room.display_name,
+            'msgtype': event.source['content']['msgtype'],
+            'body': event.source['content']['body'],
+            'origin_server_ts': event.source['origin_server_ts'],
+            'received': received,       # time.monotonic() when event was received
+            'file': f,
+            'error': error,             # Why file could not be received, or None
+        }, priority=priority)
+        INBOUND_DEPTH.set(self._events.stats()['depth'])
+        if self._bus:
+            self._bus.signal(source, priority)
+
+    def _is_mention(self, room, event):
+        # Direct messages and messages mentioning us by user id, name, or pill link
+        if room.member_count == 2:
+            return True
+        user_id = self._config['user_id']
+        content = event.source['content']
+        if user_id in ((content.get('m.mentions') or {}).get('user_ids') or []):
+            return True
+        text = (content.get('body', '') + ' ' + content.get('formatted_body', '')).lower()
+        name = room.user_name(user_id) or user_id.split(':')[0].lstrip('@')
+        return user_id.lower() in text or name.lower() in text
+
+    async def _download(self, room, event, received):
+        # Stream file to disk and store it in library. Concurrent downloads are limited both by
+        # their number and total size, and storing is done in the ingestion thread.
+        size = reserved_size(event.source['content'], self._download_max_size)
+        if size > self._download_max_size:
+            self._deliver(room, event, received, error=f'file too large ({size} bytes)')
+            return
+        try:
+            # A quick query, not queued behind ingestions but not blocking the event loop either
+            f = await self._event_loop.run_in_executor(None, self._librarian.find_source, event.url)
+            if f is None:
+                pathname = self._librarian.temp_pathname()
+                try:
+                    async with self._download_slots:
+                        async with self._download_space:
+                            await self._download_space.wait_for(
+                                lambda: self._downloading == 0 or self._downloading + size <= self._download_max_total)
+                            self._downloading += size
+                        try:
+                            await fetch(self._client, event.url, pathname, size)
+                        finally:
+                            async with self._download_space:
+                                self._downloading -= size
+                                self._download_space.notify_all()
+                    f = await self._event_loop.run_in_executor(self._ingestion, self._store, event, pathname)
+                finally:
+                    if os.path.exists(pathname):
+                        os.remove(pathname)
+            else:
+                print(f'Matrix: file {event.url} already stored as "{f.filename()}"')
+            print(f'Downloaded "{f.filename()} type {f.type()}"')
+            self._deliver(room, event, received, f=f, source='ingestion')
+        except Exception as e:
+            print(f'Matrix: failed to receive file {event.url} ({self._privacy_filter(str(e))})')
+            self._deliver(room, event, received, error=str(e))
 
-    def _sync(self):
-        self._event_loop.run_until_complete(self._client.sync(timeout=self._timeout, full_state=True))
+    def _store(self, event, pathname):
+        # Runs in the ingestion thread
+        if isinstance(event, nio.RoomEncryptedMedia):
+            decrypt_file(pathname, event.key['k'], event.hashes['sha256'], event.iv)
+        return self._librarian.add_file(event.body, move_from=pathname, source=event.url)
+
+    async def _sync_callback(self, response: nio.SyncResponse) -> None:
+        SYNCS.inc()
+        self._synced.set()
+
+    async def _sync_forever(self):
+        # Long-poll the server continuously, continuing from the stored sync token
+        sync_filter = SYNC_FILTER
+        while True:
+            try:
+                if sync_filter is SYNC_FILTER:
+                    # Filter stored on the server is preferred to sending it with each request
+                    resp = await self._client.upload_filter(**SYNC_FILTER)
+                    if isinstance(resp, nio.UploadFilterResponse):
+                        sync_filter = resp.filter_id
+                await self._client.sync_forever(
+                    timeout = self._timeout,
+                    sync_filter = sync_filter,
+                    full_state = False,
+                )
+            except Exception as e:
+                print(f'Matrix: sync failed ({self._privacy_filter(str(e))}), retrying')
+                await asyncio.sleep(SYNC_RETRY)
 
     async def _map_roominfo_to_roomid(self, info: str) -> str:
         """Attempt to convert room info to room_id.
@@ -253,6 +492,44 @@ class ToolSetMatrix(tools.ToolSetBasic):
 
 # Tests
 if __name__ == '__main__':
+    import tempfile
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    # Downloads from a stub media server: /<size> returns size bytes, /chunked-<size> without
+    # Content-Length, other paths 404
+    class MediaHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+        def do_GET(self):
+            name = self.path.split('/')[-1]
+            if not name.removeprefix('chunked-').isdigit():
+                self.send_error(404)
+                return
+            self.send_response(200)
+            if name.startswith('chunked-'):
+                self.send_header('Connection', 'close')     # Body ends when the connection closes
+            else:
+                self.send_header('Content-Length', name)
+            self.end_headers()
+            self.wfile.write(b'x' * int(name.removeprefix('chunked-')))
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MediaHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    async def test_downloads():
+        client = nio.AsyncClient(f'http://127.0.0.1:{server.server_port}', '@test:localhost')
+        client.access_token = 'token'
+        pathname = os.path.join(tempfile.mkdtemp(), 'download')
+        for media, limit in ( ('1000', 1000), ('1001', 1000), ('chunked-1000', 1000), ('chunked-5000', 1000), ('missing', 1000) ):
+            try:
+                await fetch(client, f'mxc://localhost/{media}', pathname, limit)
+                print(f'Download {media} with limit {limit}: {os.path.getsize(pathname)} bytes')
+            except Exception as e:
+                print(f'Download {media} with limit {limit}: {e}')
+        await client.close()
+    asyncio.run(test_downloads())
+    print(f'Reserved without size: {reserved_size({ "body": "a.txt" }, DOWNLOAD_MAX_SIZE)}, '
+          f'with size: {reserved_size({ "info": { "size": 1000 } }, DOWNLOAD_MAX_SIZE)}')
+
     import yaml
     import time
     CONFIG_FILE = 'config.yaml'
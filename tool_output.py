@@ -0,0 +1,96 @@
+import time
+
+import tools
+
+SPOOL_TOKENS = 2000         # Outputs longer than this are stored in the library
+PREVIEW_HEAD_TOKENS = 400   # Beginning of a stored output shown in the dialogue
+PREVIEW_TAIL_TOKENS = 200   # End of a stored output shown in the dialogue
+PAGE_TOKENS = 1000          # Size of a page returned by read_output()
+SEARCH_MAX_MATCHES = 20     # Maximum number of lines returned by search_output()
+SEARCH_LINE_MAX = 200       # Maximum length of a line returned by search_output()
+
+
+class ToolSetOutput(tools.ToolSetBasic):
+    # Keeps large code outputs out of the dialogue: they are stored in the library
+    # as internal files and only a preview with a handle is added to the context.
+    def __init__(self, config, librarian):
+        super().__init__()
+        self._librarian = librarian
+        self._spool_tokens = config.get('output_spool_tokens', SPOOL_TOKENS)
+        self._page_tokens = config.get('output_page_tokens', PAGE_TOKENS)
+        self.stats = { 'spooled': 0, 'spooled_tokens': 0 }
+
+    def tools(self):
+        return [
+('''read_output(handle: str, page: int = 0):
+    """
+    Returns one page of a long output which was stored instead of shown in full.
+    Pages are numbered from 0. The handle is given with the stored output.
+    Example: read_output(handle='@output-20250101-120000.out', page=1)
+    """
+''', self._read_output),
+('''search_output(handle: str, query: str):
+    """
+    Returns the lines of a stored long output which contain the query (case insensitive),
+    with line numbers.
+    Example: search_output(handle='@output-20250101-120000.out', query='error')
+    """
+''', self._search_output),
+        ]
+
+    def spool(self, output: str):
+        # Return output as is if it is short enough, otherwise store it and return a preview
+        if not output:
+            return output
+        tokens = self._librarian.tokenizer.tokenize(output)
+        if tokens.count() <= self._spool_tokens:
+            return output
+        f = self._librarian.add_file('output-' + time.strftime('%Y%m%d-%H%M%S'), data=output, ext='out')
+        self.stats['spooled'] += 1
+        self.stats['spooled_tokens'] += tokens.count()
+        pages = (tokens.count() + self._page_tokens - 1) // self._page_tokens
+        # output_spool_tokens may be smaller than the previews, then the tail is left out
+        head_end = min(PREVIEW_HEAD_TOKENS, tokens.count())
+        tail_begin = tokens.count() - PREVIEW_TAIL_TOKENS
+        head = output[:tokens.text_pos(head_end)]
+        tail = output[tokens.text_pos(tail_begin):] if tail_begin >= head_end else ''
+        print(f'OUTPUT spooled {tokens.count()} tokens to {f.name()}')
+        return (f'{head}\n'
+                f'[... Output of {tokens.count()} tokens, {len(output.splitlines())} lines was stored as "{f.name()}". '
+                f'Use read_output() ({pages} pages) or search_output() to see the rest ...]\n'
+                f'{tail}')
+
+    def _text(self, handle: str):
+        f = self._librarian.get_file(handle)
+        if f is None or not handle.endswith('.out'):
+            return None
+        return f.data().decode('utf-8', errors='replace')
+
+    def _read_output(self, handle: str, page: int = 0):
+        text = self._text(handle)
+        if text is None:
+            self._print(f'Output {handle} not found')
+            return
+        tokens = self._librarian.tokenizer.tokenize(text)
+        pages = (tokens.count() + self._page_tokens - 1) // self._page_tokens
+        if page < 0 or page >= pages:
+            self._print(f'Page {page} does not exist, the output has pages 0..{pages-1}')
+            return
+        begin = tokens.text_pos(page * self._page_tokens)
+        end = tokens.text_pos(min((page + 1) * self._page_tokens, tokens.count()))
+        self._print(f'[Page {page} of 0..{pages-1}]\n{text[begin:end]}\n')
+
+    def _search_output(self, handle: str, query: str):
+        text = self._text(handle)
+        if text is None:
+            self._print(f'Output {handle} not found')
+            return
+        q = query.lower()
+        matches = [ (n, line) for n, line in enumerate(text.split('\n'), 1) if q in line.lower() ]
+        if not matches:
+            self._print(f'No lines containing "{query}"')
+            return
+        result = ''.join(f'{n}: {line[:SEARCH_LINE_MAX]}\n' for n, line in matches[:SEARCH_MAX_MATCHES])
+        if len(matches) > SEARCH_MAX_MATCHES:
+            result += f'[{len(matches) - SEARCH_MAX_MATCHES} more matching lines not shown]\n'
+        self._print(result)
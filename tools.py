@@ -1,5 +1,25 @@
 from typing import Optional
 
+def tool_name(description: str):
+    # Name of the function from the description (signature and docstring)
+    return description[:description.find('(')]
+
+def tool_summary(description: str):
+    # One line summary of the function: signature and the first line of the docstring
+    lines = [ l.strip() for l in description.split('\n') ]
+    doc = ''
+    for l in lines[1:]:
+        if l == '"""' and not doc:
+            continue
+        if not l or l == '"""' or l.startswith('Example'):
+            break
+        doc += ' ' + l
+    doc = doc.strip()
+    i = doc.find('. ')
+    if i != -1:
+        doc = doc[:i+1]
+    return lines[0].rstrip(':') + ('  # ' + doc if doc else '')
+
 class ToolSetBasic():
     def __init__(self):
         self._print = self.default_print
@@ -140,3 +160,36 @@ class ToolSetSystem(ToolSetBasic):
     def _shutdown(self, reason: Optional[str] = ''):
         self.shutdown = True
         print(f'shutdown: {reason}')
+
+
+class ToolSetHelp(ToolSetBasic):
+    # Full documentation of the functions on demand, when the tools section has only an index
+    def __init__(self, tool_list):
+        super().__init__()
+        self._tool_list = tool_list
+
+    def tools(self):
+        return [
+('''help(name: str):
+    """
+    Shows the full documentation and examples of a function.
+    Example: help('send_message')
+    """
+''', self._help),
+        ]
+
+    def doc(self, name: str):
+        # Return full description of the function or None if there is no such function
+        for tool in self._tool_list:
+            for t in tool.tools():
+                if tool_name(t[0]) == name:
+                    return 'def ' + t[0]
+        return None
+
+    def _help(self, name: str):
+        doc = self.doc(name)
+        if doc is None:
+            names = [ tool_name(t[0]) for tool in self._tool_list for t in tool.tools() ]
+            self._print(f'No function {name}, available functions are: {", ".join(names)}\n')
+            return
+        self._print(doc)